@@ -0,0 +1,90 @@
+"""Talker.set_statusの判定方式を比較するベンチマークです。
+
+パターンを順にre.searchする従来の方式と、ActionMatcherによる照合を比較します。
+pattern.txtの各パターンに同義語を足して数百語に増やした場合も計測します。
+
+リポジトリの直下で実行してください。
+    python -m bench.action_matcher
+"""
+import re
+import timeit
+
+from inner.loader import Loader
+from inner.matcher import ActionMatcher
+
+MESSAGES = (
+    '牛乳',
+    'ボディソープ詰替',
+    'add',
+    'とりけし',
+    '--show',
+    '-h',
+    '牛乳\n1000\n198\nスーパー\n駅前',
+    'ものすごく長い商品名を誤字脱字込みで入力してみた場合の例です',
+)
+
+
+def search_loop(actions, text):
+    """従来のTalker.set_statusと同じ方式で判定します。
+
+    Args:
+        actions (list[dict]): 反応パターン群。
+        text (str): 文字列。
+
+    Returns:
+        str or None: 一致したパターンのstatus。
+    """
+    for ptn in actions:
+        if re.search(ptn['pattern'], text):
+            return ptn['status']
+    return None
+
+
+def grow(actions, synonyms):
+    """各パターンの選択肢に存在しない同義語を足したパターン群を返します。
+
+    Args:
+        actions (list[dict]): 反応パターン群。
+        synonyms (int): パターン毎に足す同義語の数。
+
+    Returns:
+        list[dict]: 同義語を足した反応パターン群。
+    """
+    grown = []
+    for action in actions:
+        pattern = action['pattern']
+        if pattern.startswith('^('):
+            words = '|'.join(f"{action['status']}{i}" for i in range(synonyms))
+            pattern = f'^({words}|{pattern[2:]}'
+        grown.append({'pattern': pattern, 'status': action['status']})
+    return grown
+
+
+def measure(actions, number=20000):
+    """判定結果が一致することを確認し、両方式の1メッセージあたりの時間を表示します。
+
+    Args:
+        actions (list[dict]): 反応パターン群。
+        number (int, optional): 繰り返し回数。
+    """
+    matcher = ActionMatcher(actions)
+    for text in MESSAGES:
+        assert search_loop(actions, text) == matcher.classify(text), text
+    loop = timeit.timeit(lambda: [search_loop(actions, x) for x in MESSAGES],
+                         number=number)
+    compiled = timeit.timeit(lambda: [matcher.classify(x) for x in MESSAGES],
+                             number=number)
+    count = number * len(MESSAGES)
+    print(f'  search loop : {loop / count * 1e6:8.3f} us/message')
+    print(f'  ActionMatcher: {compiled / count * 1e6:8.3f} us/message')
+
+
+def main():
+    actions = Loader.load_action()
+    for synonyms in (0, 100, 500):
+        print(f'synonyms per action: {synonyms}')
+        measure(grow(actions, synonyms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""一部のユーザーが大量に送信している間の、他のユーザーの応答時間を計測します。
+
+通常のユーザーは平均INTERVAL秒毎に1つずつ発言し、乱用するユーザーは一覧の表示と誤字の商品名を、
+応答を待たずに合わせて毎秒--abuse-rate件の割合で送り続けます。
+乱用なし, 乱用あり(制限なし), 乱用あり(制限あり)の3通りで、通常のユーザーの応答時間と断られた数、
+乱用するユーザーの発言のうち処理された割合を表示します。
+
+データベースにはbench.standinの代替データベースを使い、問い合わせ毎に--query-msミリ秒かかり、
+同時に--db-capacity件までしか処理できないものとして扱います。
+商品情報の参照でデータベースを使うように、CATALOG_CACHE=0での実行を想定しています。
+計測の前に2秒間、乱用なしで動かしてから、場合毎に結果のキャッシュを破棄します。
+
+リポジトリの直下で実行してください。
+    CATALOG_CACHE=0 python -m bench.admission
+"""
+import argparse
+import random
+import threading
+import time
+
+from bench.replay import script
+from bench.standin import StandInCursor, StandInDatabase
+from inner.admission import Admission
+from inner.catalog import Catalog
+from inner.responder import ProductResponder
+from inner.talker import Talker
+
+INTERVAL = 1
+
+
+def abuse(rng, names):
+    """乱用するユーザーの発言を1つ返します。
+    """
+    if rng.random() < 0.5:
+        return '-s'
+    return rng.choice(names)[:2] + 'ーー誤字'
+
+
+def run(talker, names, args, abusers, seed):
+    """通常のユーザーと乱用するユーザーをスレッドで動かします。
+
+    Returns:
+        dict: latencies(通常のユーザーの発言毎の秒数), refused(通常のユーザーが断られた数),
+            sent(乱用するユーザーの発言数), admitted(うち処理された数)。
+    """
+    stop = threading.Event()
+    latencies = []
+    counts = {'refused': 0, 'sent': 0, 'admitted': 0}
+    rejected = set(Admission.REPLIES.values())
+
+    def normal(index):
+        rng = random.Random(seed * 1000 + index)
+        time.sleep(rng.random() * INTERVAL)
+        while not stop.is_set():
+            for text in script(rng, names):
+                start = time.perf_counter()
+                res = talker.dialogue(f'user{index}', text)
+                latencies.append(time.perf_counter() - start)
+                counts['refused'] += res in rejected
+                time.sleep(rng.uniform(0.5, 1.5) * INTERVAL)
+
+    def abuser(index):
+        rng = random.Random(-seed * 1000 - index)
+        interval = abusers / args.abuse_rate
+        due = time.perf_counter() + rng.random() * interval
+        while not stop.is_set():
+            time.sleep(max(0, due - time.perf_counter()))
+            due += interval
+            res = talker.dialogue(f'abuser{index}', abuse(rng, names))
+            counts['sent'] += 1
+            counts['admitted'] += res not in rejected
+
+    workers = [
+        threading.Thread(target=normal, args=(i, )) for i in range(args.users)
+    ]
+    workers += [
+        threading.Thread(target=abuser, args=(i, )) for i in range(abusers)
+    ]
+    for worker in workers:
+        worker.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return {'latencies': latencies, **counts}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='流量の制限の効果の計測')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--abusers', type=int, default=32)
+    parser.add_argument('--abuse-rate', type=float, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--query-ms', type=float, default=5)
+    parser.add_argument('--db-capacity', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    database = StandInDatabase()
+    database.install()
+    names = database.seed(args.products, args.seed)
+    if Catalog.ENABLED:
+        Catalog.load()
+
+    capacity = threading.BoundedSemaphore(args.db_capacity)
+    execute = StandInCursor.execute
+
+    def slow_execute(self, sql, vars=None):
+        with capacity:
+            time.sleep(args.query_ms / 1000)
+        return execute(self, sql, vars)
+
+    StandInCursor.execute = slow_execute
+
+    print(f'users: {args.users}  abusers: {args.abusers}  '
+          f'seconds: {args.seconds}')
+    print(f"{'scenario':<18}{'turns':>7}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'refused':>9}{'abuse admitted':>16}")
+    run(Talker(), names, argparse.Namespace(**{
+        **vars(args), 'seconds': 2
+    }), 0, args.seed)
+    for label, abusers, enabled in (('no abuse', 0, True),
+                                    ('abuse, no limits', args.abusers, False),
+                                    ('abuse, limits', args.abusers, True)):
+        Admission.ENABLED = enabled
+        ProductResponder.invalidate()
+        result = run(Talker(), names, args, abusers, args.seed)
+        latencies = sorted(result['latencies'])
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        admitted = f"{result['admitted']}/{result['sent']}" if abusers else '-'
+        print(f"{label:<18}{len(latencies):>7}{p50 * 1e3:>9.2f}"
+              f"{p99 * 1e3:>9.2f}{result['refused']:>9}{admitted:>16}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""プロセスの起動からmainの読み込み完了まで(起動時間)と、最初のメッセージへの返信が届くまで(初回返信時間)を計測します。
+
+WARMUPを0(準備なし)とsync(準備してから受け付け)で切り替え、それぞれ新しいプロセスで複数回計測します。
+子プロセスはbench.standinの代替データベースに商品情報を登録してからmainを読み込み、
+署名付きのWebhookを/callbackに送って、手元の返信APIのスタブに返信が届くまでを計ります。
+
+リポジトリの直下で実行してください。
+    python -m bench.cold_start --runs 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECRET = 'cold-start-secret'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """返信APIとメッセージの上限数を取得するAPIを模したハンドラです。
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, payload):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.respond(b'{"type": "none"}')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.respond(b'{}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def child(products):
+    """子プロセスとして起動時間と初回返信時間を計測し、JSONで出力します。
+
+    Args:
+        products (int): 登録しておく商品情報の件数。
+    """
+    import base64
+    import hashlib
+    import hmac
+
+    from bench.standin import StandInDatabase
+    database = StandInDatabase()
+    database.install()
+    names = database.seed(products)
+
+    start = time.perf_counter()
+    import main
+    started = time.perf_counter() - start
+
+    body = json.dumps({
+        'destination':
+        'Ubench',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': 0,
+            'replyToken': 'cold-start',
+            'source': {
+                'type': 'user',
+                'userId': 'Ucoldstart'
+            },
+            'message': {
+                'type': 'text',
+                'id': '1',
+                'text': names[len(names) // 2]
+            },
+        }]
+    })
+    signature = base64.b64encode(
+        hmac.new(SECRET.encode(), body.encode(),
+                 hashlib.sha256).digest()).decode()
+    client = main.app.test_client()
+    start = time.perf_counter()
+    response = client.post('/callback',
+                           data=body,
+                           headers={'X-Line-Signature': signature})
+    main.dispatcher.shutdown()
+    replied = time.perf_counter() - start
+    print(
+        json.dumps({
+            'status': response.status_code,
+            'started': started,
+            'replied': replied
+        }))
+
+
+def run(endpoint, warmup, products):
+    """子プロセスを1つ起動して計測結果を受け取ります。
+    """
+    env = dict(os.environ,
+               WARMUP=warmup,
+               SESSION_STORE='memory',
+               LINE_API_ENDPOINT=endpoint,
+               YOUR_CHANNEL_ACCESS_TOKEN='token',
+               YOUR_CHANNEL_SECRET=SECRET)
+    start = time.perf_counter()
+    output = subprocess.run([
+        sys.executable, '-m', 'bench.cold_start', '--child', '--products',
+        str(products)
+    ],
+                            env=env,
+                            check=True,
+                            capture_output=True,
+                            text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - start
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='起動時間と初回返信時間の計測')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        child(args.products)
+        return
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_port}'
+    print(f'products: {args.products}  runs: {args.runs}')
+    print(f"  {'WARMUP':<8}{'startup ms':>12}{'first reply ms':>16}"
+          f"{'process ms':>12}")
+    for warmup in ('0', 'sync'):
+        results = [
+            run(endpoint, warmup, args.products) for _ in range(args.runs)
+        ]
+        assert all(x['status'] == 200 for x in results)
+        started = sorted(x['started'] for x in results)[len(results) // 2]
+        replied = sorted(x['replied'] for x in results)[len(results) // 2]
+        process = sorted(x['process'] for x in results)[len(results) // 2]
+        print(f'  {warmup:<8}{started * 1e3:>12.1f}{replied * 1e3:>16.1f}'
+              f'{process * 1e3:>12.1f}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
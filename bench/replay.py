@@ -0,0 +1,166 @@
+"""複数ユーザーの会話をTalker.dialogueに再生し、statusごとの応答時間と問い合わせ数を計測します。
+
+データベースにはbench.standinの代替データベースを使い、指定した件数の商品情報を登録してから再生します。
+流量の制限(Admission)は行いません。
+会話は検索, 候補の推測, --SHOWからの番号指定, 一覧, 登録, superadd, 取り消しを組み合わせて生成します。
+記録した会話を再生する場合は、{"user": ユーザーID, "text": 文字列}のJSONLを--transcriptに指定してください。
+
+リポジトリの直下で実行してください。
+    python -m bench.replay --products 1000 10000 100000
+    CATALOG_CACHE=0 python -m bench.replay --products 1000
+"""
+import argparse
+import json
+import random
+import time
+
+from bench.standin import BRANCHES, SHOPS, StandInDatabase
+from inner.admission import Admission
+from inner.catalog import Catalog
+from inner.talker import Talker
+
+
+def script(rng, names):
+    """ユーザー1人分の会話を生成します。
+
+    Args:
+        rng (random.Random): 乱数生成器。
+        names (list[str]): 登録されている商品名。
+
+    Returns:
+        list[str]: 送信する文字列。
+    """
+    name = rng.choice(names)
+    kind = rng.choices(
+        ('search', 'guess', 'show', 'list', 'add', 'superadd', 'cancel'),
+        weights=(50, 20, 8, 5, 7, 5, 5))[0]
+    if kind == 'search':
+        return [name]
+    if kind == 'guess':
+        return [name[:rng.randint(1, len(name))] + 'ーー誤字', '0']
+    if kind == 'show':
+        return ['--SHOW', '次', str(rng.randint(0, 40))]
+    if kind == 'list':
+        return ['-s']
+    new = f'{name}新{rng.randint(0, 99)}'
+    shop, branch = rng.choice(SHOPS), rng.choice(BRANCHES)
+    if kind == 'add':
+        return [
+            'add', new, '1',
+            str(rng.randint(50, 2000)), shop, branch, 'yes'
+        ]
+    if kind == 'superadd':
+        return [f'{new}\n1\n{rng.randint(50, 2000)}\n{shop}\n{branch}', 'yes']
+    return ['add', new, 'とりけし']
+
+
+def generate(names, users, turns, seed=0):
+    """複数ユーザーの会話を交互に並べた記録を生成します。
+
+    Args:
+        names (list[str]): 登録されている商品名。
+        users (int): 同時に会話するユーザーの数。
+        turns (int): 生成する発言の数。
+        seed (int, optional): 乱数の種。
+
+    Returns:
+        list[dict]: {'user': ユーザーID, 'text': 文字列}の一覧。
+    """
+    rng = random.Random(seed)
+    pending = {f'user{i}': [] for i in range(users)}
+    transcript = []
+    while len(transcript) < turns:
+        user = rng.choice(list(pending))
+        if not pending[user]:
+            pending[user] = script(rng, names)
+        transcript.append({'user': user, 'text': pending[user].pop(0)})
+    return transcript
+
+
+def percentile(values, p):
+    """昇順に並んだ値のpパーセンタイルを返します。
+    """
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def replay(database, transcript):
+    """会話を再生し、statusごとの応答時間と問い合わせ数を集計します。
+
+    Args:
+        database (StandInDatabase): 代替データベース。
+        transcript (list[dict]): 会話の記録。
+
+    Returns:
+        dict[str, dict]: statusごとのlatencies(秒)とqueries。
+    """
+    talker = Talker()
+    statuses = {}
+    set_status = talker.set_status
+
+    def spy(user, text):
+        set_status(user, text)
+        statuses['last'] = user['status']
+
+    talker.set_status = spy
+    results = {}
+    for turn in transcript:
+        queries = database.queries
+        start = time.perf_counter()
+        talker.dialogue(turn['user'], turn['text'])
+        elapsed = time.perf_counter() - start
+        result = results.setdefault(statuses['last'], {
+            'latencies': [],
+            'queries': 0
+        })
+        result['latencies'].append(elapsed)
+        result['queries'] += database.queries - queries
+    return results
+
+
+def report(products, results):
+    """集計結果を表示します。
+    """
+    print(f'products: {products}  catalog: {Catalog.ENABLED}')
+    print(f"  {'status':<10}{'turns':>7}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'queries/turn':>14}")
+    for status, result in sorted(results.items()):
+        latencies = sorted(result['latencies'])
+        count = len(latencies)
+        print(f'  {status:<10}{count:>7}'
+              f'{percentile(latencies, 50) * 1e3:>10.3f}'
+              f'{percentile(latencies, 95) * 1e3:>10.3f}'
+              f'{percentile(latencies, 99) * 1e3:>10.3f}'
+              f"{result['queries'] / count:>14.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Talker.dialogueの会話再生ベンチマーク')
+    parser.add_argument('--products', type=int, nargs='+', default=[1000])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--transcript', help='再生する会話の記録(JSONL)')
+    parser.add_argument('--record', help='生成した会話を保存するパス(JSONL)')
+    args = parser.parse_args(argv)
+    Admission.ENABLED = False
+    for products in args.products:
+        database = StandInDatabase()
+        database.install()
+        names = database.seed(products, args.seed)
+        if Catalog.ENABLED:
+            Catalog.load()
+        if args.transcript:
+            with open(args.transcript, 'r', encoding='utf-8') as f:
+                transcript = [json.loads(x) for x in f if x.strip()]
+        else:
+            transcript = generate(names, args.users, args.turns, args.seed)
+        if args.record:
+            with open(args.record, 'w', encoding='utf-8') as f:
+                for turn in transcript:
+                    print(json.dumps(turn, ensure_ascii=False), file=f)
+        database.queries = 0
+        report(products, replay(database, transcript))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""ReplyDispatcherを手元のHTTPスタブに対して動かし、送信の所要時間と再送を確認します。
+
+スタブは返信APIのパスだけを受け付け、FAIL_EVERY件に1件は503を返します。
+送信の確認にはline-bot-sdkが必要です。
+
+リポジトリの直下で実行してください。
+    python -m bench.reply_stub
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from linebot import LineBotApi
+
+from inner.dispatcher import KeepAliveHttpClient, ReplyDispatcher
+
+REPLIES = 200
+FAIL_EVERY = 10
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """返信APIを模したハンドラです。
+    """
+    protocol_version = 'HTTP/1.1'
+    received = []
+    connections = set()
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.lock:
+            self.connections.add(self.client_address)
+            count = len(self.received)
+            fail = (self.path == '/v2/bot/message/reply'
+                    and count % FAIL_EVERY == 0)
+            self.received.append(body['replyToken'])
+        status, payload = (503, b'{"message":"stub"}') if fail else (200,
+                                                                     b'{}')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_port}'
+    api = LineBotApi('token',
+                     endpoint=endpoint,
+                     http_client=KeepAliveHttpClient)
+    dispatcher = ReplyDispatcher(api)
+    start = time.perf_counter()
+    for i in range(REPLIES):
+        dispatcher.send(f'token{i}', f'reply {i}')
+    enqueued = time.perf_counter() - start
+    dispatcher.shutdown()
+    delivered = time.perf_counter() - start
+    server.shutdown()
+    tokens = set(StubHandler.received)
+    print(f'enqueue : {enqueued / REPLIES * 1e6:8.1f} us/reply')
+    print(f'delivery: {delivered:8.3f} s for {REPLIES} replies')
+    print(f'requests: {len(StubHandler.received)} (retries included)')
+    print(f'tokens  : {len(tokens)} / {REPLIES} delivered')
+    print(f'client connections: {len(StubHandler.connections)}')
+
+
+if __name__ == '__main__':
+    main()
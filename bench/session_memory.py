@@ -0,0 +1,86 @@
+"""多数のユーザーが会話の途中にある状態を作り、1ユーザーあたりのメモリ使用量を計測します。
+
+ユーザーは--SHOWの番号待ち, 一覧の次のページ待ち, 商品名の推測の番号待ち, 商品登録の途中のいずれかで止めます。
+データベースにはbench.standinの代替データベースを使います。
+計測するのはTalker.usersに保持された会話状態の増分(tracemalloc)と、pickleした場合の大きさです。
+
+リポジトリの直下で実行してください。
+    python -m bench.session_memory --sessions 10000 100000
+"""
+import argparse
+import pickle
+import random
+import tracemalloc
+
+from bench.standin import StandInDatabase
+from inner.catalog import Catalog
+from inner.talker import Talker
+
+OPENERS = (('--SHOW', ), ('-s', ), ('牛乳ーー誤字', ), ('add', '新商品', '1'))
+
+
+def populate(talker, sessions, seed=0):
+    """sessions人のユーザーを会話の途中まで進めます。
+
+    Args:
+        talker (Talker): 会話を処理するTalker。
+        sessions (int): ユーザーの数。
+        seed (int, optional): 乱数の種。
+    """
+    rng = random.Random(seed)
+    for i in range(sessions):
+        for text in rng.choice(OPENERS):
+            talker.dialogue(f'user{i}', text)
+
+
+def measure(sessions, seed=0):
+    """会話状態の保持に使ったメモリを計測します。
+
+    Args:
+        sessions (int): ユーザーの数。
+        seed (int, optional): 乱数の種。
+
+    Returns:
+        dict: held(保持しているユーザー数), bytes(1ユーザーあたりのバイト数),
+            pickled(pickleした場合の平均バイト数)。
+    """
+    talker = Talker()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    populate(talker, sessions, seed)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    users = list(talker.users)
+    sample = users[::max(1, len(users) // 1000)]
+    pickled = sum(len(pickle.dumps(talker.users[x])) for x in sample)
+    return {
+        'held': len(users),
+        'bytes': (after - before) / sessions,
+        'pickled': pickled / len(sample),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='会話状態のメモリ使用量の計測')
+    parser.add_argument('--sessions',
+                        type=int,
+                        nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    database = StandInDatabase()
+    database.install()
+    database.seed(args.products, args.seed)
+    if Catalog.ENABLED:
+        Catalog.load()
+    print(f"{'sessions':>10}{'held':>10}{'bytes/session':>16}"
+          f"{'pickled bytes':>16}")
+    for sessions in args.sessions:
+        result = measure(sessions, args.seed)
+        print(f"{sessions:>10}{result['held']:>10}{result['bytes']:>16.0f}"
+              f"{result['pickled']:>16.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""多数のスレッドから同時にTalker.dialogueを呼び出し、会話状態の辞書が競合しないことを確かめます。
+
+発言は少数のユーザーに集中させ、同じユーザーの発言を別々のスレッドが同時に処理しようとする状況を作ります。
+同じユーザーのdialogueが重なって実行された回数, 例外の数, 処理した発言数と応答時間を表示します。
+有効期限は短く設定し、期限を待つスレッドによる削除も並行して起こします。
+最後に全てのユーザーが期限切れで削除されることを確かめます。
+重なった回数, 例外の数, 削除されずに残ったユーザーの数のいずれかが0でなければ、終了コード1で終了します。
+
+データベースにはbench.standinの代替データベースを使います。 流量の制限(Admission)は行いません。
+
+リポジトリの直下で実行してください。
+    python -m bench.session_stress --threads 1 8 64
+    SESSION_SHARDS=1 python -m bench.session_stress --threads 64
+    SESSION_STORE=sqlite SESSION_SWEEP=0.1 \\
+        python -m bench.session_stress --threads 8
+SQLiteSessionsで実行する場合は、期限切れのユーザーが待つ間に削除されるよう、SESSION_SWEEPを短くしてください。
+"""
+import argparse
+import queue
+import random
+import sys
+import threading
+import time
+
+from bench.replay import script
+from bench.standin import StandInDatabase
+from inner.admission import Admission
+from inner.catalog import Catalog
+from inner.talker import Talker
+
+
+class StressTalker(Talker):
+    """同じユーザーのdialogueが重なって実行されたことを数えるTalkerです。
+    有効期限はTIMEOUTミリ秒にします。
+    """
+    TIMEOUT = 200
+
+    def __init__(self):
+        super().__init__()
+        self.active = {}
+        self.overlaps = 0
+        self.expired = 0
+        self.__lock = threading.Lock()
+
+    def entry_user(self, user_id, text):
+        with self.__lock:
+            self.active[user_id] = self.active.get(user_id, 0) + 1
+            if self.active[user_id] > 1:
+                self.overlaps += 1
+        try:
+            time.sleep(0)
+            return super().entry_user(user_id, text)
+        finally:
+            with self.__lock:
+                self.active[user_id] -= 1
+
+    def expire_user(self, user_id, user):
+        with self.__lock:
+            self.expired += 1
+        if user['responder'] is not None:
+            user['responder'].exit()
+
+    def set_timeout(self, user, **timeout):
+        super().set_timeout(user, milliseconds=self.TIMEOUT)
+
+
+def run(talker, messages, threads):
+    """発言をthreads個のスレッドで処理します。
+
+    Args:
+        talker (Talker): 会話を処理するTalker。
+        messages (list[tuple[str, str]]): ユーザーIDと文字列。
+        threads (int): スレッドの数。
+
+    Returns:
+        dict: seconds(経過秒数), latencies(発言毎の秒数), errors(例外の数)。
+    """
+    tasks = queue.SimpleQueue()
+    for message in messages:
+        tasks.put(message)
+    latencies = []
+    errors = []
+
+    def work():
+        while True:
+            try:
+                user_id, text = tasks.get_nowait()
+            except queue.Empty:
+                return
+            start = time.perf_counter()
+            try:
+                talker.dialogue(user_id, text)
+            except Exception as e:
+                errors.append(repr(e))
+            latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {
+        'seconds': time.perf_counter() - start,
+        'latencies': latencies,
+        'errors': errors
+    }
+
+
+def main(argv=None):
+    """計測を行います。
+
+    Returns:
+        int: 終了コード。 競合, 例外, 残ったユーザーのいずれかがあれば1です。
+    """
+    parser = argparse.ArgumentParser(description='会話状態の辞書の並行処理の検証')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--turns', type=int, default=20000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    Admission.ENABLED = False
+    database = StandInDatabase()
+    database.install()
+    names = database.seed(args.products, args.seed)
+    if Catalog.ENABLED:
+        Catalog.load()
+
+    rng = random.Random(args.seed)
+    messages = []
+    while len(messages) < args.turns:
+        user_id = f'user{rng.randrange(args.users)}'
+        messages.extend((user_id, text) for text in script(rng, names))
+    messages = messages[:args.turns]
+
+    print(f'users: {args.users}  turns: {len(messages)}')
+    failed = False
+    print(f"{'threads':>8}{'turns/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'overlaps':>10}{'errors':>8}{'left':>6}")
+    for threads in args.threads:
+        talker = StressTalker()
+        result = run(talker, messages, threads)
+        time.sleep(StressTalker.TIMEOUT / 1000 * 3)
+        latencies = sorted(result['latencies'])
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        rate = len(messages) / result['seconds']
+        print(f"{threads:>8}{rate:>10.0f}{p50 * 1e3:>9.2f}{p99 * 1e3:>9.2f}"
+              f"{talker.overlaps:>10}{len(result['errors']):>8}"
+              f"{len(talker.users):>6}")
+        for error in sorted(set(result['errors']))[:5]:
+            print(f'    {error}')
+        failed = failed or bool(talker.overlaps or result['errors']
+                                or len(talker.users))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
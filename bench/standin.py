@@ -0,0 +1,318 @@
+"""ベンチマーク用に、Postgresの代わりにプロセス内のSQLiteを使うための代替データベースです。
+
+installするとDatabase.cursorとSchema.setupを置き換え、
+Responder, Catalogが発行するsqlをSQLiteで実行できる形に変換して実行します。
+Postgres固有の構文を使うAddResponder.UPSERT_SQL, BatchAddResponder.DISTINCTION_SQL,
+BatchAddResponder.BATCH_UPSERT_SQL, ProductResponder.PREFIX_SQL,
+ProductResponder.RETRIEVE_SQL, Catalog.SUMMARY_SQL, Catalog.CHANGES_SQL,
+WebhookEvents.CLAIM_SQL, WebhookEvents.PRUNE_SQLは、
+同じ結果を返すSQLiteのsqlで個別に実行します。
+商品名の要約は配列の代わりに(商品名, 順位)毎の行で保持します。
+
+発行されたsqlの数を数えるため、1回の会話あたりの問い合わせ数を計測できます。
+"""
+import json
+import random
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from inner.catalog import Catalog
+from inner.database import Database
+from inner.responder import AddResponder, BatchAddResponder, ProductResponder
+from inner.schema import Schema
+from inner.webhook import WebhookEvents
+
+WORDS = ('牛乳', '低脂肪乳', '食パン', '卵', '納豆', '豆腐', 'ヨーグルト', 'バター', 'チーズ', 'ハム',
+         'ボディソープ', 'シャンプー', 'リンス', '洗剤', '柔軟剤', 'ティッシュ', 'トイレットペーパー', 'Milk',
+         'Coffee', 'Tea')
+SHOPS = ('スーパーA', 'スーパーB', 'ドラッグC', 'コンビニD')
+BRANCHES = ('駅前', '本', '北口', '南口', '中央')
+
+# PREFIX_SQLの二分探索で次に調べる先頭部分の長さと、その長さで一致する商品名があるかどうかです。
+PROBE = ('case when found >= 3 then (found + missed) / 2 '
+         'when missed > 3 then 3 else missed - 1 end')
+HIT = ('exists (select 1 from products where instr(lower(name), '
+       f'lower(substr(:text, 1, {PROBE}))) > 0)')
+PREFIX_SQL = f"""
+    with recursive probes(found, missed) as (
+        select 0, length(:text) + 1
+        union all
+        select case when {HIT} then {PROBE} else found end,
+            case when {HIT} then missed else {PROBE} end
+        from probes where missed - found > 1
+    ), longest as (
+        select max(found) as n from probes
+    )
+    select distinct p.name, l.n as length
+    from longest as l join products as p
+        on instr(lower(p.name), lower(substr(:text, 1, l.n))) > 0
+    where l.n > 0
+"""
+SUMMARY_SQL = """
+    insert into product_summaries (name, n, amount, price, shop, shop_branch)
+    select name, n, amount, price, shop, shop_branch from (
+        select name, amount, price, shop, shop_branch,
+            row_number() over (
+                partition by name
+                order by unit_price is null, unit_price, amount
+            ) as n
+        from products where name in (select value from json_each(:names))
+    ) where n <= :limit
+"""
+RETRIEVE_SQL = """
+    select name, amount, price, shop, shop_branch from product_summaries
+    where name = :name order by n
+"""
+CLAIM_SQL = """
+    insert into webhook_events (event_id, received)
+    values (:event_id, julianday('now'))
+    on conflict (event_id) do update set received = excluded.received
+    where webhook_events.received < julianday('now') - :ttl / 86400.0
+"""
+PRUNE_SQL = """
+    delete from webhook_events
+    where received < julianday('now') - :ttl / 86400.0
+"""
+
+
+def translate(sql):
+    """Postgres向けのsqlをSQLiteで実行できる形に変換します。
+
+    Args:
+        sql (str): Postgres向けのsql。
+
+    Returns:
+        str: SQLite向けのsql。
+    """
+    sql = sql.replace(' collate "ja_JP.utf8"', '')
+    sql = re.sub(r'%\((\w+)\)s', r':\1', sql)
+    sql = sql.replace('%s', '?').replace('%%', '%')
+    return re.sub(r'\bilike\b', 'like', sql)
+
+
+class StandInCursor:
+    """StandInDatabaseのカーソルです。 psycopg2のカーソルと同じように使えます。
+    """
+    def __init__(self, database):
+        self.__database = database
+        self.__cursor = database.connection.cursor()
+        self.__rows = []
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __upsert(self, params):
+        """AddResponder.UPSERT_SQLと同じ処理を行います。
+        """
+        cursor = self.__cursor
+        if params['check']:
+            cursor.execute(
+                'select 1 from products '
+                "where name in (:name || '詰替', :name || '本体')", params)
+            if cursor.fetchone():
+                return []
+        cursor.execute(
+            'insert into products (name, amount, price, shop, shop_branch) '
+            'values (:name, :amount, :price, :shop, :shop_branch) '
+            'on conflict (name, amount, shop, shop_branch) '
+            'do update set price = excluded.price', params)
+        cursor.execute('update catalog_version set version = version + 1 '
+                       'where id = 1 returning version')
+        rows = cursor.fetchall()
+        cursor.execute(
+            'insert into catalog_changes (version, name) '
+            'values (:version, :name)', {
+                'version': rows[0][0],
+                'name': params['name']
+            })
+        cursor.execute('delete from catalog_changes where version <= :version',
+                       {'version': rows[0][0] - params['retention']})
+        return rows
+
+    def __batch_upsert(self, params):
+        """BatchAddResponder.BATCH_UPSERT_SQLと同じ処理を行います。
+        """
+        cursor = self.__cursor
+        rows = []
+        for values in zip(params['names'], params['amounts'], params['prices'],
+                          params['shops'], params['shop_branches']):
+            cursor.execute(
+                'select 1 from products where name = ? and amount = ? '
+                'and shop = ? and shop_branch = ?',
+                (values[0], values[1], values[3], values[4]))
+            inserted = cursor.fetchone() is None
+            cursor.execute(
+                'insert into products '
+                '(name, amount, price, shop, shop_branch) '
+                'values (?, ?, ?, ?, ?) '
+                'on conflict (name, amount, shop, shop_branch) '
+                'do update set price = excluded.price', values)
+            rows.append((values[0], values[1], values[3], values[4], inserted))
+        return rows
+
+    def execute(self, sql, vars=None):
+        self.__database.queries += 1
+        if sql == AddResponder.UPSERT_SQL:
+            self.__rows = self.__upsert(vars)
+            self.rowcount = len(self.__rows)
+            return
+        if sql == BatchAddResponder.BATCH_UPSERT_SQL:
+            self.__rows = self.__batch_upsert(vars)
+            self.rowcount = len(self.__rows)
+            return
+        if sql == Catalog.CHANGES_SQL:
+            vars = {
+                'version': vars['version'],
+                'names': json.dumps(vars['names'])
+            }
+            sql = ('insert into catalog_changes (version, name) '
+                   'select :version, value from json_each(:names)')
+        elif sql == BatchAddResponder.DISTINCTION_SQL:
+            vars = {'names': json.dumps(vars['names'])}
+            sql = ('select name from products '
+                   'where name in (select value from json_each(:names))')
+        elif sql == Catalog.SUMMARY_SQL:
+            vars = {'names': json.dumps(vars['names']), 'limit': vars['limit']}
+            self.__cursor.execute(
+                'delete from product_summaries '
+                'where name in (select value from json_each(:names))', vars)
+            sql = SUMMARY_SQL
+        elif sql == ProductResponder.PREFIX_SQL:
+            sql = PREFIX_SQL
+        elif sql == ProductResponder.RETRIEVE_SQL:
+            sql = RETRIEVE_SQL
+        elif sql == WebhookEvents.CLAIM_SQL:
+            sql = CLAIM_SQL
+        elif sql == WebhookEvents.PRUNE_SQL:
+            sql = PRUNE_SQL
+        else:
+            sql = translate(sql)
+        self.__cursor.execute(sql, () if vars is None else vars)
+        self.__rows = self.__cursor.fetchall()
+        self.rowcount = self.__cursor.rowcount
+
+    def fetchall(self):
+        rows, self.__rows = self.__rows, []
+        return rows
+
+    def fetchone(self):
+        if not self.__rows:
+            return None
+        return self.__rows.pop(0)
+
+    def close(self):
+        self.__cursor.close()
+
+
+class StandInDatabase:
+    """productsとcatalog_versionを持つ、プロセス内のSQLiteです。
+
+    Attributes:
+        connection (sqlite3.Connection): SQLiteとの接続です。
+        queries (int): 発行されたsqlの数です。
+    """
+    def __init__(self):
+        """テーブルを用意します。
+        """
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.queries = 0
+        self.__lock = threading.RLock()
+        self.connection.executescript("""
+            create table products (
+                name text not null, amount numeric not null,
+                price integer not null,
+                shop text not null, shop_branch text not null,
+                unit_price real generated always as
+                    (price * 1.0 / nullif(amount, 0)) stored,
+                unique (name, amount, shop, shop_branch)
+            );
+            create index products_name_unit_price
+                on products (name, unit_price, amount);
+            create table catalog_version (
+                id integer primary key, version integer not null
+            );
+            insert into catalog_version values (1, 0);
+            create table product_summaries (
+                name text not null, n integer not null,
+                amount numeric not null, price integer not null,
+                shop text not null, shop_branch text not null,
+                primary key (name, n)
+            );
+            create table catalog_changes (
+                version integer not null, name text not null,
+                primary key (version, name)
+            );
+            create table webhook_events (
+                event_id text primary key, received real not null
+            );
+        """)
+
+    @contextmanager
+    def cursor(self, commit=False):
+        """Database.cursorの代わりにカーソルを貸し出します。
+
+        Args:
+            commit (bool, optional): ブロックを正常に抜けた場合に反映するかどうか。
+
+        Yields:
+            StandInCursor: カーソル。
+        """
+        with self.__lock:
+            cursor = StandInCursor(self)
+            try:
+                yield cursor
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def seed(self, products, seed=0):
+        """商品情報を登録します。
+        商品名1つあたり1から3件の店舗の情報を登録します。
+
+        Args:
+            products (int): 登録する商品情報の件数。
+            seed (int, optional): 乱数の種。
+
+        Returns:
+            list[str]: 登録した商品名。
+        """
+        rng = random.Random(seed)
+        names = []
+        rows = []
+        i = 0
+        while len(rows) < products:
+            name = f'{WORDS[i % len(WORDS)]}{i // len(WORDS)}'
+            names.append(name)
+            for shop in rng.sample(SHOPS, rng.randint(1, 3)):
+                amount = rng.choice((1, 2, 6, 10, 0.5, 1.5))
+                rows.append((name, amount, rng.randint(50, 2000), shop,
+                             rng.choice(BRANCHES)))
+            i += 1
+        with self.__lock:
+            self.connection.executemany(
+                'insert or ignore into products '
+                '(name, amount, price, shop, shop_branch) '
+                'values (?, ?, ?, ?, ?)', rows[:products])
+            self.connection.execute(
+                SUMMARY_SQL.replace(
+                    'where name in (select value from json_each(:names))', ''),
+                {'limit': Catalog.SUMMARY_SIZE})
+            self.connection.commit()
+        return names
+
+    def install(self):
+        """Database.cursorとSchema.setupをこの代替データベースに置き換えます。
+        プールを使わないため、Database.warmは何もしません。
+        """
+        Database.cursor = staticmethod(self.cursor)
+        Database.warm = staticmethod(lambda: None)
+        Schema.setup = staticmethod(lambda: None)
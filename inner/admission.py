@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from inner.cache import LRUCache
+from inner.database import Database
+from inner.metrics import Metrics
+
+REJECTED = Metrics.counter('linebot_admission_rejected_total',
+                           'Messages refused by admission control by reason.',
+                           ('reason', ))
+
+
+class TokenBucket:
+    """トークンバケットです。 rate毎秒の割合でトークンが溜まり、burst個まで溜めておけます。
+
+    Examples:
+        >>> bucket = TokenBucket(rate=1, burst=2)
+        >>> bucket.take(), bucket.take(), bucket.take()
+        (True, True, False)
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'lock')
+
+    def __init__(self, rate, burst):
+        """満杯のバケットを用意します。
+
+        Args:
+            rate (float): 1秒あたりに溜まるトークンの数。
+            burst (float): 溜めておけるトークンの最大数。
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """トークンを1つ取り出します。
+
+        Returns:
+            bool: 取り出せたかどうか。
+        """
+        with self.lock:
+            now = time.monotonic()
+            refilled = self.tokens + (now - self.updated) * self.rate
+            self.tokens = min(self.burst, refilled)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Admission:
+    """Talker.dialogueに届いたメッセージを処理するかどうかを決めるクラスです。
+
+    ユーザー毎と、ユーザー毎のstatus毎にトークンバケットを持ち、どちらかが空であれば処理を断ります。
+    さらに、データベースを使う処理を同時に行う数をCONCURRENCYまでに制限し、
+    空きをWAIT秒待っても得られなければ処理を断ります。
+    断った場合はデータベースを使わずに定型文を返すため、一部のユーザーが大量に送信しても他のユーザーの応答は遅れません。
+
+    トークンバケットと枠はプロセス毎に持ちます。
+    RATE_LIMITSは全てのワーカーの合計として指定し、各ワーカーはWORKERSで割った値で制限します。
+    同じユーザーのメッセージがワーカーに均等に届く場合に、合計が指定した値になります。
+    DB_CONCURRENCYはプロセス毎の接続プールを守るための値で、ワーカー毎に適用されます。
+    全体の同時実行数はワーカー数倍になります。
+
+    このクラスはインスタンスを必要としません。
+
+    以下の環境変数で設定を変更できます。
+        ADMISSION: 0を指定すると制限を行いません。
+        RATE_LIMITS: 「キー=毎秒の回数/最大の連続回数」をカンマで区切って並べます。
+            キーはuser(ユーザー毎)かstatusの名前です。 標準はLIMITSです。
+        WEB_CONCURRENCY: ワーカーの数。 標準は1です。
+        DB_CONCURRENCY: ワーカー毎に、データベースを使う処理を同時に行う数。
+            標準はデータベースのプールの上限です。
+        ADMISSION_WAIT: データベースを使う処理の空きを待つ秒数。 標準は1秒です。
+
+    Attributes:
+        LIMITS (str): RATE_LIMITSの標準値です。
+        EXEMPT (tuple[str]): 制限しないstatusです。 データベースを使わない処理です。
+        REPLIES (dict): 断った理由毎の定型文です。
+    """
+    ENABLED = os.getenv('ADMISSION', '1') != '0'
+    LIMITS = 'user=1/20,products=1/20,show=0.5/10,add=1/20,superadd=0.5/10'
+    WORKERS = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+    CONCURRENCY = int(os.getenv('DB_CONCURRENCY', Database.MAX_SIZE))
+    WAIT = float(os.getenv('ADMISSION_WAIT', 1))
+    EXEMPT = ('cancel', 'help')
+    REPLIES = {
+        'user': '短時間に多くのメッセージを受け取りました。\nしばらく時間をおいてから送信してください。',
+        'status': '同じ操作が続いています。\nしばらく時間をおいてから送信してください。',
+        'busy': 'ただいま混み合っています。\nしばらく時間をおいてから送信してください。',
+    }
+    __slots = threading.BoundedSemaphore(max(1, CONCURRENCY))
+    __inflight = 0
+    __inflight_lock = threading.Lock()
+    __limits = None
+    __buckets = None
+
+    @staticmethod
+    def parse(spec):
+        """RATE_LIMITSの書式の文字列を読み込みます。
+
+        Examples:
+            >>> Admission.parse('user=1/10, show=0.2/5')
+            {'user': (1.0, 10.0), 'show': (0.2, 5.0)}
+
+        Args:
+            spec (str): 「キー=毎秒の回数/最大の連続回数」をカンマで区切った文字列。
+
+        Returns:
+            dict: キーと(毎秒の回数, 最大の連続回数)の辞書。
+        """
+        limits = {}
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            try:
+                key, value = item.split('=')
+                rate, burst = value.split('/')
+                limits[key.strip()] = (float(rate), float(burst))
+            except ValueError:
+                print(f"RATE_LIMITSの{item}を読み込めません。無視します。")
+        return limits
+
+    @classmethod
+    def __get_buckets(cls):
+        """制限の設定と、トークンバケットを保持するキャッシュを返します。
+        制限はWORKERSで割ります。 ただし、最大の連続回数は1回を下回りません。
+        キャッシュの有効期限は、空のバケットが満杯に戻るまでの最長の秒数です。
+
+        Returns:
+            tuple[dict, LRUCache]: 制限の設定とキャッシュ。
+        """
+        if cls.__buckets is None:
+            limits = {
+                key: (rate / cls.WORKERS, max(1.0, burst / cls.WORKERS))
+                for key, (rate, burst) in cls.parse(
+                    os.getenv('RATE_LIMITS', cls.LIMITS)).items()
+            }
+            ttl = max(
+                (burst / rate for rate, burst in limits.values() if rate > 0),
+                default=60)
+            cls.__limits = limits
+            cls.__buckets = LRUCache('admission', maxsize=100000, ttl=ttl)
+        return cls.__limits, cls.__buckets
+
+    @classmethod
+    def __take(cls, key, limit):
+        """keyのトークンバケットからトークンを1つ取り出します。
+
+        Args:
+            key (hashable): バケットのキー。
+            limit (tuple[float, float] or None): 毎秒の回数と最大の連続回数。 Noneの場合は制限しません。
+
+        Returns:
+            bool: 取り出せたかどうか。
+        """
+        if limit is None:
+            return True
+        buckets = cls.__get_buckets()[1]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*limit)
+        buckets.put(key, bucket)
+        return bucket.take()
+
+    @classmethod
+    def admit(cls, user_id, status):
+        """ユーザーのメッセージを処理するかどうかを判定します。
+
+        Args:
+            user_id (str): ユーザーID。
+            status (str): メッセージのstatus。
+
+        Returns:
+            str or None: 断る場合はその理由('user', 'status')です。 処理する場合はNoneです。
+        """
+        if not cls.ENABLED or status in cls.EXEMPT:
+            return None
+        limits = cls.__get_buckets()[0]
+        if not cls.__take(('user', user_id), limits.get('user')):
+            reason = 'user'
+        elif not cls.__take((status, user_id), limits.get(status)):
+            reason = 'status'
+        else:
+            return None
+        REJECTED.inc(reason=reason)
+        return reason
+
+    @classmethod
+    @contextmanager
+    def slot(cls):
+        """データベースを使う処理の枠を取得します。 withを抜けると返却します。
+
+            with Admission.slot() as admitted:
+                if not admitted:
+                    return Admission.reply('busy')
+
+        Yields:
+            bool: 枠を取得できたかどうか。
+        """
+        if not cls.ENABLED:
+            yield True
+            return
+        with Metrics.stage('admission'):
+            admitted = cls.__slots.acquire(timeout=cls.WAIT)
+        if not admitted:
+            REJECTED.inc(reason='busy')
+            yield False
+            return
+        with cls.__inflight_lock:
+            cls.__inflight += 1
+        try:
+            yield True
+        finally:
+            with cls.__inflight_lock:
+                cls.__inflight -= 1
+            cls.__slots.release()
+
+    @classmethod
+    def inflight(cls):
+        """データベースを使う処理を行っている数を返します。
+
+        Returns:
+            int: 処理の数。
+        """
+        return cls.__inflight
+
+    @classmethod
+    def reply(cls, reason):
+        """断った理由に応じた定型文を返します。
+
+        Args:
+            reason (str): 理由。
+
+        Returns:
+            str: 定型文。
+        """
+        return cls.REPLIES[reason]
+
+
+Metrics.gauge('linebot_admission_inflight',
+              'Messages holding a database slot.', Admission.inflight)
+
+if __name__ == '__main__':
+    print("This module is not script file.")
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+
+from inner.metrics import Metrics
+
+REQUESTS = Metrics.counter('linebot_cache_requests_total',
+                           'Result cache lookups by cache and result.',
+                           ('cache', 'result'))
+
+
+class LRUCache:
+    """件数の上限と有効期限を持つキャッシュです。
+    上限を超えると最も長く参照されていない値から破棄し、有効期限を過ぎた値は参照時に破棄します。
+
+    参照の結果はhits, missesとlinebot_cache_requests_totalに記録します。
+
+    Examples:
+        >>> cache = LRUCache('example', maxsize=2, ttl=60)
+        >>> cache.put('牛乳', 'a')
+        >>> cache.put('卵', 'b')
+        >>> cache.get('牛乳')
+        'a'
+        >>> cache.put('納豆', 'c')
+        >>> cache.get('卵') is None
+        True
+        >>> cache.discard('牛乳')
+        >>> cache.stats()
+        {'hits': 1, 'misses': 1, 'size': 1}
+    """
+    def __init__(self, name, maxsize=1024, ttl=60):
+        """初期化します。
+
+        Args:
+            name (str): キャッシュの名前。 計測値のラベルに使います。
+            maxsize (int, optional): 保持する値の最大数。 0の場合は何も保持しません。
+            ttl (float, optional): 値の有効期限の秒数。
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """値を返します。
+
+        Args:
+            key (hashable): キー。
+
+        Returns:
+            object: 値。 無い場合や有効期限を過ぎている場合はNoneです。
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.__entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+        REQUESTS.inc(cache=self.name,
+                     result='miss' if entry is None else 'hit')
+        return None if entry is None else entry[1]
+
+    def put(self, key, value):
+        """値を保持します。
+
+        Args:
+            key (hashable): キー。
+            value (object): 値。 Noneは保持できません。
+        """
+        if self.maxsize <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def add(self, key, value=True):
+        """有効な値を保持していなければ値を保持します。
+        確認と保持は一度に行うため、同じキーで同時に呼び出してもTrueを返すのは一度だけです。
+
+        Examples:
+            >>> cache = LRUCache('example')
+            >>> cache.add('event'), cache.add('event')
+            (True, False)
+
+        Args:
+            key (hashable): キー。
+            value (object, optional): 値。
+
+        Returns:
+            bool: 新たに保持したかどうか。
+        """
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            added = entry is None or entry[0] < now
+            if added:
+                self.misses += 1
+                if self.maxsize > 0:
+                    self.__entries[key] = (now + self.ttl, value)
+            else:
+                self.hits += 1
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+        REQUESTS.inc(cache=self.name, result='miss' if added else 'hit')
+        return added
+
+    def discard(self, key):
+        """値を破棄します。
+
+        Args:
+            key (hashable): キー。
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """全ての値を破棄します。
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """参照の結果と保持している値の数を返します。
+
+        Returns:
+            dict: hits, misses, size。
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
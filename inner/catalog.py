@@ -0,0 +1,399 @@
+import os
+import threading
+import time
+
+import psycopg2
+
+from inner.database import Database
+from inner.ngram import NgramIndex
+from inner.schema import Schema
+
+
+class Catalog:
+    """商品情報をプロセス内に保持し、参照時のデータベースへの問い合わせを省くためのクラスです。
+
+    商品名の一覧と、商品名毎に単価の安い順, 数量の少ない順で並べた商品情報、商品名のn-gram索引を保持します。
+    AddResponderが登録した商品は登録直後に反映されます。
+    他のプロセスによる登録は、データベース上の版数(catalog_version)を比較して検出し、
+    版数毎に記録された商品名(catalog_changes)の情報だけを読み込み直します。
+    記録を辿れない程離れた場合は全て読み込み直します。
+
+    startを呼ぶと版数の確認をスレッドで行い、参照時にはデータベースへ問い合わせません。
+    データベースに接続できない間は、最後に読み込んだ情報をそのまま返します。
+
+    このクラスはインスタンスを必要としません。
+
+    以下の環境変数で設定を変更できます。
+        CATALOG_CACHE: 0を指定するとこのクラスを使わず、毎回データベースを参照します。
+        CATALOG_CHECK: 版数を確認する間隔の秒数。 標準は5秒です。
+
+    Attributes:
+        SUMMARY_SQL (str): 指定した商品名の要約(product_summaries)を作り直すsqlです。
+            要約は商品名毎に単価の安い順, 数量の少ない順で最大SUMMARY_SIZE件の商品情報を配列で持ちます。
+        CHANGES_SQL (str): 版数と変更した商品名の配列を受け取り、catalog_changesに一度に記録するsqlです。
+        RETENTION (int): catalog_changesに記録を残す版数です。
+        INCREMENTAL_LIMIT (int): 一度に読み込み直す商品名がこれより多い場合は、全て読み込み直します。
+    """
+    ENABLED = os.getenv('CATALOG_CACHE', '1') != '0'
+    CHECK_INTERVAL = float(os.getenv('CATALOG_CHECK', 5))
+    COLUMNS = 'name, amount, price, shop, shop_branch'
+    SUMMARY_SQL = """
+        insert into product_summaries
+            (name, amounts, prices, shops, shop_branches)
+        select name, array_agg(amount order by n), array_agg(price order by n),
+            array_agg(shop order by n), array_agg(shop_branch order by n)
+        from (
+            select name, amount, price, shop, shop_branch,
+                row_number() over (
+                    partition by name order by unit_price, amount
+                ) as n
+            from products where name = any(%(names)s)
+        ) as ranked
+        where n <= %(limit)s
+        group by name
+        on conflict (name) do update set amounts = excluded.amounts,
+            prices = excluded.prices, shops = excluded.shops,
+            shop_branches = excluded.shop_branches
+    """
+    CHANGES_SQL = ('insert into catalog_changes (version, name) '
+                   'select %(version)s, unnest(%(names)s::text[])')
+    SUMMARY_SIZE = 5
+    RETENTION = 1000
+    INCREMENTAL_LIMIT = 100
+    __names = ()
+    __positions = {}
+    __index = NgramIndex()
+    __rows = {}
+    __version = None
+    __checked = 0
+    __watcher = None
+    __listeners = []
+    __lock = threading.RLock()
+
+    @staticmethod
+    def __sort_key(row):
+        """商品情報を単価の安い順, 数量の少ない順に並べるためのキーです。
+
+        Args:
+            row (tuple): 商品情報。
+
+        Returns:
+            tuple: 単価, 数量。
+        """
+        _, amount, price, _, _ = row
+        if not amount:
+            return (float('inf'), amount)
+        return (price / amount, amount)
+
+    @classmethod
+    def __publish(cls, names, rows, version, index):
+        """読み込んだ商品情報を参照できるようにします。
+
+        Args:
+            names (tuple[str]): 並べ替え済みの商品名の一覧。
+            rows (dict[str, tuple]): 商品名毎の商品情報群。
+            version (int): 読み込んだ時点の版数。
+            index (NgramIndex): 商品名の索引。
+        """
+        cls.__rows = rows
+        cls.__names = tuple(names)
+        cls.__positions = {x: i for i, x in enumerate(cls.__names)}
+        cls.__index = index
+        cls.__version = version
+        cls.__checked = time.monotonic()
+
+    @classmethod
+    def subscribe(cls, listener):
+        """商品情報を読み込み直した時に呼び出す関数を登録します。
+        関数には読み込み直した商品名の集合が渡されます。 全て読み込み直した場合はNoneです。
+
+        Args:
+            listener (func): 呼び出す関数。
+        """
+        cls.__listeners.append(listener)
+
+    @classmethod
+    def __notify(cls, names):
+        """登録されている関数を呼び出します。
+
+        Args:
+            names (set[str] or None): 読み込み直した商品名。
+        """
+        for listener in cls.__listeners:
+            listener(names)
+
+    @classmethod
+    def bump(cls, cursor, names=()):
+        """データベース上の版数を1つ進め、変更した商品名を記録して新しい版数を返します。
+        商品情報を変更するトランザクションの中で呼び出してください。
+
+        Args:
+            cursor (connect.cursor): 登録作業中のカーソル。
+            names (iterable[str], optional): 変更した商品名。
+
+        Returns:
+            int: 新しい版数。
+        """
+        cursor.execute('update catalog_version set version = version + 1 '
+                       'where id = 1 returning version')
+        version = cursor.fetchone()[0]
+        cursor.execute(cls.CHANGES_SQL, {
+            'version': version,
+            'names': list(set(names))
+        })
+        cursor.execute('delete from catalog_changes where version <= %s',
+                       (version - cls.RETENTION, ))
+        return version
+
+    @classmethod
+    def summarize(cls, cursor, names):
+        """商品名の要約(product_summaries)を作り直します。
+        商品情報を変更するトランザクションの中で、変更してbumpを呼び出した後に呼び出してください。
+        bumpが取るcatalog_versionの行ロックで登録作業が一つずつになるため、
+        他のトランザクションが未確定の変更を残したまま要約を作り、古い要約で上書きすることはありません。
+
+        Args:
+            cursor (connect.cursor): 登録作業中のカーソル。
+            names (iterable[str]): 変更した商品名。
+        """
+        cursor.execute(cls.SUMMARY_SQL, {
+            'names': list(set(names)),
+            'limit': cls.SUMMARY_SIZE
+        })
+
+    @classmethod
+    def load(cls):
+        """データベースから全ての商品情報を読み込み直します。
+        """
+        Schema.setup()
+        with cls.__lock:
+            with Database.cursor() as cursor:
+                cursor.execute(
+                    'select version from catalog_version where id = 1')
+                version = cursor.fetchone()[0]
+                cursor.execute(f'select {cls.COLUMNS} from products '
+                               'order by name collate "ja_JP.utf8"')
+                rows = cursor.fetchall()
+            grouped = {}
+            for row in rows:
+                grouped.setdefault(str(row[0]), []).append(row)
+            cls.__publish(
+                grouped, {
+                    name: tuple(sorted(rows, key=cls.__sort_key))
+                    for name, rows in grouped.items()
+                }, version, NgramIndex(grouped))
+            cls.__notify(None)
+
+    @classmethod
+    def __changes(cls, cursor, version):
+        """保持している版数からversionまでに変更された商品名を返します。
+
+        Args:
+            cursor (connect.cursor): カーソル。
+            version (int): データベース上の版数。
+
+        Returns:
+            set[str] or None: 変更された商品名。 記録を辿れない場合はNoneです。
+        """
+        cursor.execute(
+            'select version, name from catalog_changes '
+            'where version > %s and version <= %s', (cls.__version, version))
+        changes = cursor.fetchall()
+        expected = set(range(cls.__version + 1, version + 1))
+        if {x[0] for x in changes} != expected:
+            return None
+        return {x[1] for x in changes}
+
+    @classmethod
+    def __apply(cls, cursor, names, version):
+        """指定した商品名の商品情報だけを読み込み直します。
+        新しい商品名はデータベース上の並び順と同じ位置に挿入し、索引にも加えます。
+
+        Args:
+            cursor (connect.cursor): カーソル。
+            names (set[str]): 読み込み直す商品名。
+            version (int): 読み込んだ時点の版数。
+        """
+        rows = dict(cls.__rows)
+        added = []
+        for name in names:
+            cursor.execute(
+                f'select {cls.COLUMNS} from products where name = %s',
+                (name, ))
+            found = cursor.fetchall()
+            if not found:
+                rows.pop(name, None)
+                cls.__index.discard(name)
+                continue
+            if name not in rows:
+                added.append(name)
+                cls.__index.add(name)
+            rows[name] = tuple(sorted(found, key=cls.__sort_key))
+        listed = [x for x in cls.__names if x in rows]
+        positions = []
+        for name in added:
+            cursor.execute(
+                'select count(distinct name) from products '
+                'where name collate "ja_JP.utf8" < %s collate "ja_JP.utf8"',
+                (name, ))
+            positions.append((cursor.fetchone()[0], name))
+        for position, name in sorted(positions):
+            listed.insert(position, name)
+        cls.__publish(listed, rows, version, cls.__index)
+        cls.__notify(names)
+
+    @classmethod
+    def update(cls):
+        """データベース上の版数を確認し、変わっていれば変更された商品名の情報を読み込み直します。
+        """
+        with cls.__lock:
+            with Database.cursor() as cursor:
+                cursor.execute(
+                    'select version from catalog_version where id = 1')
+                version = cursor.fetchone()[0]
+                if version == cls.__version:
+                    cls.__checked = time.monotonic()
+                    return
+                names = cls.__changes(cursor, version)
+                if names is not None and len(names) <= cls.INCREMENTAL_LIMIT:
+                    cls.__apply(cursor, names, version)
+                    return
+            cls.load()
+
+    @classmethod
+    def __watch(cls):
+        """CHECK_INTERVAL秒毎に版数を確認します。
+        """
+        while True:
+            time.sleep(cls.CHECK_INTERVAL)
+            try:
+                cls.update()
+            except psycopg2.Error as e:
+                print(f"catalog update failed: {e}")
+
+    @classmethod
+    def start(cls):
+        """版数を確認するスレッドを起動します。
+        起動後は参照時に版数を確認しません。
+        """
+        with cls.__lock:
+            if cls.__watcher is None:
+                cls.__watcher = threading.Thread(target=cls.__watch,
+                                                 daemon=True)
+                cls.__watcher.start()
+
+    @classmethod
+    def sync(cls):
+        """前回の確認からCHECK_INTERVAL秒以上経っていれば版数を確認し、変わっていれば読み込み直します。
+        一度も読み込んでいない場合は読み込みます。
+        startでスレッドを起動している場合や、データベースに接続できない場合は何もしません。
+        """
+        if cls.__version is None:
+            with cls.__lock:
+                if cls.__version is None:
+                    cls.load()
+            return
+        if cls.__watcher is not None:
+            return
+        if time.monotonic() - cls.__checked < cls.CHECK_INTERVAL:
+            return
+        with cls.__lock:
+            if time.monotonic() - cls.__checked < cls.CHECK_INTERVAL:
+                return
+            try:
+                cls.update()
+            except psycopg2.Error as e:
+                print(f"catalog update failed: {e}")
+                cls.__checked = time.monotonic()
+
+    @classmethod
+    def refresh(cls, names, version):
+        """自プロセスで登録した商品の情報を反映します。
+        他のプロセスによる変更が間に挟まっていた場合は、それらの変更も読み込みます。
+        データベースに接続できない場合は、次回の確認で反映されます。
+
+        Args:
+            names (iterable[str]): 登録した商品名。
+            version (int): 登録時に進めた版数。
+        """
+        with cls.__lock:
+            if cls.__version is None:
+                return
+            try:
+                if version != cls.__version + 1:
+                    cls.update()
+                    return
+                with Database.cursor() as cursor:
+                    cls.__apply(cursor, set(names), version)
+            except psycopg2.Error as e:
+                print(f"catalog refresh failed: {e}")
+
+    @classmethod
+    def names(cls):
+        """登録されている商品名の一覧を返します。
+
+        Returns:
+            tuple[str]: 商品名の一覧。
+        """
+        cls.sync()
+        return cls.__names
+
+    @classmethod
+    def page(cls, after=None, limit=30):
+        """商品名の一覧のうち、afterより後の商品名を最大limit件返します。
+        afterが一覧に無い場合は最初から返します。
+
+        Args:
+            after (str, optional): 前のページの最後の商品名。
+            limit (int, optional): 返す件数の上限。
+
+        Returns:
+            tuple[str]: 商品名の一覧。
+        """
+        cls.sync()
+        names = cls.__names
+        start = cls.__positions.get(after, -1) + 1
+        if start and (start > len(names) or names[start - 1] != after):
+            start = 0
+        return names[start:start + limit]
+
+    @classmethod
+    def retrieve(cls, name, limit=5):
+        """商品名が一致する商品情報を単価の安い順, 数量の少ない順で返します。
+
+        Args:
+            name (str): 商品名。
+            limit (int, optional): 返す件数の上限。
+
+        Returns:
+            tuple[tuple]: 商品情報群。
+        """
+        cls.sync()
+        return cls.__rows.get(name, ())[:limit]
+
+    @classmethod
+    def search(cls, text, limit=10):
+        """表記揺れや誤字を許して、文字列に似た商品名を一致度の高い順に返します。
+
+        Args:
+            text (str): 商品名の一部。
+            limit (int, optional): 返す件数の上限。
+
+        Returns:
+            list[tuple[str, float]]: 商品名と一致度(0から1)の組。
+        """
+        cls.sync()
+        return cls.__index.search(text, limit)
+
+
+Database.prepare('catalog_summary',
+                 Catalog.SUMMARY_SQL,
+                 names='text[]',
+                 limit='int')
+Database.prepare('catalog_changes',
+                 Catalog.CHANGES_SQL,
+                 version='bigint',
+                 names='text[]')
+
+if __name__ == '__main__':
+    print("This module is not script file.")
@@ -0,0 +1,340 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+
+from inner.loader import Loader
+from inner.metrics import Metrics
+
+SQL_SECONDS = Metrics.histogram('linebot_sql_seconds',
+                                'Time spent executing a SQL statement.',
+                                ('statement', ))
+DB_ERRORS = Metrics.counter('linebot_db_errors_total',
+                            'Database errors by exception type.', ('error', ))
+PREPARED = Metrics.counter(
+    'linebot_prepared_statements_total',
+    'Prepared statement executions by whether the connection already had '
+    'the plan.', ('statement', 'result'))
+
+
+class PreparedStatement:
+    """サーバー側で準備(prepare)して実行するsqlです。
+
+    %(key)s形式の引数を$1, $2, ...に置き換えたPREPARE文と、引数を渡すEXECUTE文を持ちます。
+    引数の型は宣言した順に指定するため、型の推測に頼らずに済みます。
+
+    Examples:
+        >>> statement = PreparedStatement(
+        ...     'lookup', 'select * from products where name = %(name)s',
+        ...     {'name': 'text'})
+        >>> statement.prepare_sql
+        'prepare lookup (text) as select * from products where name = $1'
+        >>> statement.execute_sql
+        'execute lookup (%s)'
+
+    Attributes:
+        name (str): 準備したsqlの名前です。
+        sql (str): 元のsqlです。
+        keys (tuple[str]): 引数の名前です。 $1から順に対応します。
+        prepare_sql (str): 接続毎に一度だけ発行するPREPARE文です。
+        execute_sql (str): 引数を渡して実行するEXECUTE文です。
+    """
+    def __init__(self, name, sql, types):
+        """初期化します。
+
+        Args:
+            name (str): 準備したsqlの名前。
+            sql (str): %(key)s形式の引数を持つsql。
+            types (dict[str, str]): 引数の名前と型。 順に$1, $2, ...になります。
+        """
+        self.name = name
+        self.sql = sql
+        self.keys = tuple(types)
+        query = sql
+        for i, key in enumerate(self.keys, 1):
+            query = query.replace(f'%({key})s', f'${i}')
+        query = query.replace('%%', '%').strip()
+        params = f" ({', '.join(types.values())})" if types else ''
+        self.prepare_sql = f'prepare {name}{params} as {query}'
+        self.execute_sql = f'execute {name}'
+        if types:
+            self.execute_sql += f" ({', '.join(['%s'] * len(self.keys))})"
+
+    def values(self, vars):
+        """EXECUTE文に渡す引数を、$1から順に並べて返します。
+
+        Args:
+            vars (dict): 引数の名前と値。
+
+        Returns:
+            list: 引数の値。
+        """
+        return [vars[key] for key in self.keys]
+
+
+class PreparingConnection(extensions.connection):
+    """準備済みのsqlの名前を記録する接続です。
+    準備したsqlはセッションの間だけ有効なため、接続毎に記録します。
+
+    Attributes:
+        prepared (set[str]): この接続で準備済みのsqlの名前です。
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class TimedCursor(extensions.cursor):
+    """sqlの実行時間をlinebot_sql_secondsに記録するカーソルです。
+    sqlの最初の単語(select, insert, with等)毎に記録します。
+
+    Database.prepareで登録したsqlは、接続毎に一度だけ準備し、以降はEXECUTE文で実行します。
+    その場合は準備したsqlの名前毎に記録し、準備済みだったかどうかをlinebot_prepared_statements_totalに記録します。
+    """
+    def execute(self, query, vars=None):
+        if isinstance(vars, dict):
+            statement = Database.statement(query, self.connection)
+            if statement is not None:
+                return self.execute_prepared(statement, vars)
+        if isinstance(query, str):
+            statement = query.split(None, 1)[0].lower()
+        else:
+            statement = 'composed'
+        with SQL_SECONDS.time(statement=statement):
+            return super().execute(query, vars)
+
+    def execute_prepared(self, statement, vars):
+        """準備したsqlを実行します。 この接続で準備していなければ先に準備します。
+
+        Args:
+            statement (PreparedStatement): 準備するsql。
+            vars (dict): 引数の名前と値。
+        """
+        prepared = self.connection.prepared
+        with SQL_SECONDS.time(statement=statement.name):
+            if statement.name in prepared:
+                PREPARED.inc(statement=statement.name, result='hit')
+            else:
+                super().execute(statement.prepare_sql)
+                prepared.add(statement.name)
+                PREPARED.inc(statement=statement.name, result='prepare')
+            return super().execute(statement.execute_sql,
+                                   statement.values(vars))
+
+
+class Database:
+    """データベースとの接続をプロセス全体で共有するためのクラスです。
+
+    接続はコネクションプールで管理し、sqlを発行している間だけ貸し出します。
+    接続を確保するまでの時間、sqlの実行時間、エラーの件数はMetricsに記録します。
+    このクラスはインスタンスを必要としません。
+
+    以下の環境変数でプールの設定を変更できます。
+        DB_POOL_MIN: 常に確保しておく接続数。 標準は1です。
+        DB_POOL_MAX: 同時に貸し出せる接続の最大数。 標準は10です。
+        DB_POOL_TIMEOUT: 接続が空くまで待機する秒数。 標準は5秒です。
+        DB_POOL_CHECK: この秒数以上使われていなかった接続は貸し出す前に疎通を確認します。 標準は30秒です。
+        DB_PREPARE: 0を指定するとprepareで登録したsqlも準備せずに実行します。
+            トランザクション単位で接続を切り替えるPgBouncer等を経由する場合に指定してください。
+    """
+    MIN_SIZE = int(os.getenv('DB_POOL_MIN', 1))
+    MAX_SIZE = int(os.getenv('DB_POOL_MAX', 10))
+    TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+    CHECK_INTERVAL = float(os.getenv('DB_POOL_CHECK', 30))
+    PREPARE = os.getenv('DB_PREPARE', '1') != '0'
+    __statements = {}
+    __pool = None
+    __slots = None
+    __last_used = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def __get_pool(cls):
+        """コネクションプールを返します。
+        初めて呼ばれた時にプールを生成します。
+
+        Returns:
+            ThreadedConnectionPool: コネクションプール。
+        """
+        if cls.__pool is None:
+            with cls.__lock:
+                if cls.__pool is None:
+                    cls.__slots = threading.BoundedSemaphore(cls.MAX_SIZE)
+                    cls.__pool = pool.ThreadedConnectionPool(
+                        cls.MIN_SIZE,
+                        cls.MAX_SIZE,
+                        Loader.load_uri(),
+                        connection_factory=PreparingConnection)
+        return cls.__pool
+
+    @classmethod
+    def __is_alive(cls, connection):
+        """接続が使用可能かどうかを返します。
+        しばらく使われていなかった接続には実際にsqlを発行して確認します。
+
+        Args:
+            connection (psycopg2.connection): 確認する接続。
+
+        Returns:
+            bool: 使用可能かどうか。
+        """
+        if connection.closed:
+            return False
+        last_used = cls.__last_used.get(id(connection), 0)
+        if time.monotonic() - last_used < cls.CHECK_INTERVAL:
+            return True
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute('select 1')
+        except psycopg2.Error:
+            return False
+        return True
+
+    @classmethod
+    def prepare(cls, name, sql, /, **types):
+        """sqlを準備して実行するよう登録します。
+        登録したsqlと同じ文字列を、引数を辞書で渡してexecuteすると、準備したsqlで実行します。
+
+            Database.prepare('lookup', LOOKUP_SQL, name='text')
+
+        Args:
+            name (str): 準備したsqlの名前。
+            sql (str): %(key)s形式の引数を持つsql。
+            **types (str): 引数の名前と型。 sqlの引数を全て指定してください。 nameやsqlという名前の引数も指定できます。
+        """
+        cls.__statements[sql] = PreparedStatement(name, sql, types)
+
+    @classmethod
+    def statement(cls, sql, connection=None):
+        """sqlに対応する、準備して実行するsqlを返します。
+
+        Args:
+            sql (str): sql。
+            connection (psycopg2.connection, optional): 実行する接続。
+                準備済みのsqlを記録できない接続ならNoneを返します。
+
+        Returns:
+            PreparedStatement or None: 準備して実行するsql。 登録されていない場合はNoneです。
+        """
+        if not cls.PREPARE or not isinstance(sql, str):
+            return None
+        if connection is not None and not hasattr(connection, 'prepared'):
+            return None
+        return cls.__statements.get(sql)
+
+    @classmethod
+    def prepared_statements(cls):
+        """登録されている準備して実行するsqlを返します。
+
+        Returns:
+            tuple[PreparedStatement]: 準備して実行するsql。
+        """
+        return tuple(cls.__statements.values())
+
+    @classmethod
+    def acquire(cls):
+        """プールから使用可能な接続を借ります。
+        借りた接続は必ずreleaseで返却してください。
+
+        Raises:
+            PoolError: TIMEOUT秒待っても接続が空かなかった場合。
+
+        Returns:
+            psycopg2.connection: データベースとの接続。
+        """
+        with Metrics.stage('db_acquire'):
+            connections = cls.__get_pool()
+            if not cls.__slots.acquire(timeout=cls.TIMEOUT):
+                DB_ERRORS.inc(error='PoolTimeout')
+                raise pool.PoolError(f"{cls.TIMEOUT}秒以内に接続を確保できませんでした。")
+            try:
+                connection = connections.getconn()
+                while not cls.__is_alive(connection):
+                    cls.__last_used.pop(id(connection), None)
+                    connections.putconn(connection, close=True)
+                    connection = connections.getconn()
+            except Exception:
+                cls.__slots.release()
+                raise
+        return connection
+
+    @classmethod
+    def warm(cls):
+        """プールを生成し、MIN_SIZE本の接続の疎通を確認しておきます。
+        起動直後の最初の問い合わせで接続を待たないよう、トラフィックを受け付ける前に呼び出してください。
+        """
+        connections = [cls.acquire() for _ in range(cls.MIN_SIZE)]
+        for connection in connections:
+            cls.release(connection)
+
+    @classmethod
+    def release(cls, connection, broken=False):
+        """借りた接続をプールに返却します。
+
+        Args:
+            connection (psycopg2.connection): 返却する接続。
+            broken (bool, optional): 接続が壊れている場合は真にしてください。 プールに戻さず破棄します。
+        """
+        broken = broken or bool(connection.closed)
+        if broken:
+            cls.__last_used.pop(id(connection), None)
+        else:
+            cls.__last_used[id(connection)] = time.monotonic()
+        try:
+            cls.__pool.putconn(connection, close=broken)
+        finally:
+            cls.__slots.release()
+
+    @classmethod
+    @contextmanager
+    def cursor(cls, commit=False):
+        """接続を借り、カーソルを貸し出します。
+        ブロックを抜けると接続はプールに返却されます。
+
+        commitを真にするとブロック内のsqlは一つのトランザクションとして扱われ、
+        正常に抜けた場合にのみデータベースに反映されます。
+
+        Args:
+            commit (bool, optional): sqlを発行した際、データベースに結果を反映するかどうか。 標準では反映させません。
+
+        Yields:
+            connect.cursor: カーソル。
+        """
+        connection = cls.acquire()
+        broken = False
+        try:
+            connection.autocommit = not commit
+            with connection.cursor(cursor_factory=TimedCursor) as cursor:
+                yield cursor
+            if commit:
+                connection.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            DB_ERRORS.inc(error=type(e).__name__)
+            broken = True
+            raise
+        except Exception as e:
+            if isinstance(e, psycopg2.Error):
+                DB_ERRORS.inc(error=type(e).__name__)
+            if commit and not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            cls.release(connection, broken)
+
+    @classmethod
+    def close(cls):
+        """プールに保持している接続を全て閉じます。
+        """
+        with cls.__lock:
+            if cls.__pool is not None:
+                cls.__pool.closeall()
+            cls.__pool = None
+            cls.__last_used.clear()
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.models import TextSendMessage
+from requests.adapters import HTTPAdapter
+
+from inner.metrics import Metrics
+
+REPLY_FAILURES = Metrics.counter('linebot_reply_failures_total',
+                                 'Replies that could not be delivered.',
+                                 ('reason', ))
+
+
+class KeepAliveHttpClient(RequestsHttpClient):
+    """接続を使い回すLineBotApi用のHTTPクライアントです。
+
+    requests.Sessionの接続プールを使うため、送信毎のTCP, TLSの確立を省けます。
+    """
+    def __init__(self,
+                 timeout=RequestsHttpClient.DEFAULT_TIMEOUT,
+                 pool_size=10):
+        """接続プールを用意します。
+
+        Args:
+            timeout (float or tuple, optional): 応答を待つ秒数。
+            pool_size (int, optional): 保持する接続の最大数。
+        """
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.get(url,
+                                    headers=headers,
+                                    params=params,
+                                    stream=stream,
+                                    timeout=timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.post(url,
+                                     headers=headers,
+                                     data=data,
+                                     timeout=timeout)
+        return RequestsHttpResponse(response)
+
+
+class ReplyDispatcher:
+    """返信をリクエストのスレッドから切り離し、ワーカースレッドで送信します。
+
+    一時的な失敗(接続エラー, 429, 5xx)は、返信トークンの期限内で間隔を空けながら再送します。
+    送信待ちが上限に達している間は、呼び出し元のスレッドで直接送信します。
+
+    以下の環境変数で設定を変更できます。
+        REPLY_WORKERS: 送信するスレッドの数。 標準は4です。
+        REPLY_QUEUE: 送信待ちにできる返信の数。 標準は100です。
+        REPLY_DEADLINE: 返信を受け付けてから再送を諦めるまでの秒数。 標準は20秒です。
+
+    Attributes:
+        RETRY_STATUS (tuple[int]): 再送するHTTPステータスコードです。
+    """
+    WORKERS = int(os.getenv('REPLY_WORKERS', 4))
+    QUEUE_SIZE = int(os.getenv('REPLY_QUEUE', 100))
+    DEADLINE = float(os.getenv('REPLY_DEADLINE', 20))
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, api):
+        """送信するスレッドを用意します。
+
+        Args:
+            api (LineBotApi): 返信に使うLineBotApi。
+        """
+        self.__api = api
+        self.__executor = ThreadPoolExecutor(max_workers=self.WORKERS)
+        self.__slots = threading.BoundedSemaphore(self.QUEUE_SIZE)
+
+    def __deliver(self, reply_token, text, deadline):
+        """返信を送信します。
+        一時的な失敗の場合、期限内であれば再送します。
+
+        Args:
+            reply_token (str): 返信トークン。
+            text (str): 返信する文字列。
+            deadline (float): 再送を諦める時刻(time.monotonic)。
+        """
+        wait = 0.2
+        while True:
+            try:
+                with Metrics.stage('reply'):
+                    self.__api.reply_message(reply_token,
+                                             TextSendMessage(text=text))
+                return
+            except LineBotApiError as e:
+                if e.status_code not in self.RETRY_STATUS:
+                    print(f"reply failed: {e.status_code} {e.error.message}")
+                    REPLY_FAILURES.inc(reason=str(e.status_code))
+                    return
+                err = e.status_code
+            except requests.RequestException as e:
+                err = e
+            if time.monotonic() + wait > deadline:
+                print(f"reply gave up: {err}")
+                REPLY_FAILURES.inc(reason='deadline')
+                return
+            time.sleep(wait)
+            wait *= 2
+
+    def __run(self, reply_token, text, deadline):
+        """ワーカースレッドで返信を送信し、送信待ちの枠を返却します。
+        """
+        try:
+            self.__deliver(reply_token, text, deadline)
+        finally:
+            self.__slots.release()
+
+    def send(self, reply_token, text):
+        """返信を送信待ちに追加します。
+
+        Args:
+            reply_token (str): 返信トークン。
+            text (str): 返信する文字列。
+        """
+        deadline = time.monotonic() + self.DEADLINE
+        if not self.__slots.acquire(blocking=False):
+            self.__deliver(reply_token, text, deadline)
+            return
+        try:
+            self.__executor.submit(self.__run, reply_token, text, deadline)
+        except RuntimeError:
+            self.__slots.release()
+            self.__deliver(reply_token, text, deadline)
+
+    def warm(self):
+        """返信APIのサーバーとの接続を確立しておきます。
+        接続を使い回すHTTPクライアントの場合、最初の返信でTCP, TLSの確立を待たずに済みます。
+        接続には、line-bot-sdk 1.15.0でも使える、メッセージの上限数を取得するAPIを使います。
+        失敗しても返信時に接続し直せるため、例外は記録するだけで送出しません。
+        """
+        try:
+            self.__api.get_message_quota(timeout=self.DEADLINE)
+        except Exception as e:
+            print(f"reply warm-up failed: {e!r}")
+
+    def shutdown(self, wait=True):
+        """送信待ちの返信を送り終えてからスレッドを終了します。
+
+        Args:
+            wait (bool, optional): 送り終えるまで待機するかどうか。
+        """
+        self.__executor.shutdown(wait=wait)
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
@@ -1,3 +1,6 @@
+import re
+
+
 def generate_words(text):
     """受け取った文字列を1文字ずつ減らして返します。
 
@@ -70,5 +73,73 @@ def text_to_value(text, mode='both'):
         return i
 
 
+def format_product_name(name):
+    """商品名に詰め替え、本体を表す語句がある場合適切な形式に置換します。
+
+    Examples:
+        >>> format_product_name('シャンプー詰め替え')
+        'シャンプー詰替'
+        >>> format_product_name('シャンプーほんたい')
+        'シャンプー本体'
+
+    Args:
+        name (str): 商品名。
+
+    Returns:
+        str: 置換した商品名。
+    """
+    name = re.sub('詰め?替え?', '詰替', name)
+    name = re.sub('つめかえ', '詰替', name)
+    name = re.sub('ほんたい', '本体', name)
+    return name
+
+
+def need_distinction(name):
+    """商品を登録する際、"本体"あるいは"詰替"という区別の追加が必要になり得るかどうかを返します。
+    すでに商品名末尾が"本体"あるいは"詰替"である場合はFalseとして扱います。
+
+    Examples:
+        >>> need_distinction('シャンプー')
+        True
+        >>> need_distinction('シャンプー詰替')
+        False
+
+    Args:
+        name (str): 商品名。
+
+    Returns:
+        bool: 区別の追加が必要になり得るかどうか。
+    """
+    if len(name) < 2:
+        return False
+    if name[-2:] in ('本体', '詰替'):
+        return False
+    if name[-4:] in ('ほんたい', 'つめかえ'):
+        return False
+    return True
+
+
+def format_shop_branch(text):
+    """支店名の末尾にある"支店"あるいは"店"を取り除きます。
+
+    Examples:
+        >>> format_shop_branch('駅前支店')
+        '駅前'
+        >>> format_shop_branch('駅前店')
+        '駅前'
+
+    Args:
+        text (str): 支店名。
+
+    Returns:
+        str: 末尾を取り除いた支店名。
+    """
+    if text[-2:] == '支店':
+        return text[:-2]
+    elif text[-1:] == '店':
+        return text[:-1]
+    return text
+
+
 if __name__ == '__main__':
     print("This module is not script file.")
@@ -0,0 +1,265 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from pathlib import Path
+
+from inner.catalog import Catalog
+from inner.database import Database
+from inner.funcs import format_product_name, format_shop_branch, text_to_value
+from inner.schema import Schema
+
+
+class CopyStream:
+    """文字列のイテレータを、COPYが読み込めるファイルオブジェクトとして振舞わせます。
+    読み込まれた分だけイテレータを進めるため、全ての行をメモリに載せることはありません。
+    """
+    def __init__(self, lines):
+        """初期化します。
+
+        Args:
+            lines (iterator[str]): 改行を含む行のイテレータ。
+        """
+        self.__lines = lines
+        self.__buffer = ''
+
+    def read(self, size=-1):
+        """最大でsize文字を返します。
+
+        Args:
+            size (int, optional): 読み込む文字数。負の値の場合は全て読み込みます。
+
+        Returns:
+            str: 読み込んだ文字列。 読み終えた場合は空文字列です。
+        """
+        chunks = [self.__buffer]
+        length = len(self.__buffer)
+        while size < 0 or length < size:
+            line = next(self.__lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.__buffer = data[size:]
+        return data[:size]
+
+
+class Importer:
+    """CSV, JSONL形式の商品情報をまとめてデータベースに登録します。
+
+    商品情報はCOPYで一時テーブルに流し込み、一つのトランザクションでproductsへ反映します。
+    商品名、分量、店、支店名が同じ商品が存在する場合はAddResponderと同じく価格を更新します。
+    商品名と支店名はAddResponderと同じ規則で整形します。
+
+    次の行は登録せず、rejectsに理由と共に記録します。
+        必要な項目が欠けている行、分量や価格が数値でない行。
+        "本体"あるいは"詰替"の区別が必要な商品名の行。 登録済みの商品名に加え、同じファイル内の商品名とも照合します。
+
+    ファイル内で商品名、分量、店、支店名が同じ行が複数ある場合は後の行を登録します。
+
+    Attributes:
+        FIELDS (tuple[str]): 商品情報の項目名です。 CSVの場合は1行目に項目名が必要です。
+    """
+    FIELDS = ('name', 'amount', 'price', 'shop', 'shop_branch')
+
+    def __init__(self):
+        """初期化します。
+        """
+        self.__rejects = []
+
+    def __reject(self, line, reason):
+        """登録しない行を記録します。
+
+        Args:
+            line (int): 行番号。
+            reason (str): 理由。
+        """
+        self.__rejects.append((line, reason))
+
+    def read(self, path, format_=None):
+        """ファイルから商品情報を1行ずつ読み込みます。
+
+        Args:
+            path (str or Path): ファイルのパス。
+            format_ (str, optional): 'csv'または'jsonl'。 省略した場合は拡張子から判断します。
+
+        Yields:
+            tuple[int, dict]: 行番号と商品情報。
+        """
+        path = Path(path)
+        if format_ is None:
+            format_ = 'jsonl' if path.suffix in ('.jsonl', '.json') else 'csv'
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            if format_ == 'jsonl':
+                for line, text in enumerate(f, 1):
+                    if not text.strip():
+                        continue
+                    try:
+                        record = json.loads(text)
+                    except ValueError:
+                        self.__reject(line, 'JSONとして読み込めません。')
+                        continue
+                    if not isinstance(record, dict):
+                        self.__reject(line, 'JSONがオブジェクトではありません。')
+                        continue
+                    yield line, record
+            else:
+                reader = csv.DictReader(f)
+                for record in reader:
+                    yield reader.line_num, record
+
+    def validate(self, line, record):
+        """商品情報を検証し、整形した値を返します。
+        登録できない場合は理由を記録し、Noneを返します。
+
+        Args:
+            line (int): 行番号。
+            record (dict): 商品情報。
+
+        Returns:
+            tuple or None: 行番号, 商品名, 分量, 価格, 店, 支店名。
+        """
+        values = {}
+        for key in self.FIELDS:
+            value = record.get(key)
+            value = '' if value is None else str(value).strip()
+            if not value:
+                self.__reject(line, f'{key}がありません。')
+                return None
+            values[key] = value
+        amount = text_to_value(values['amount'])
+        if amount is None or amount <= 0:
+            self.__reject(line, f"分量が正の数値ではありません: {values['amount']}")
+            return None
+        price = text_to_value(values['price'], int)
+        if price is None:
+            self.__reject(line, f"価格が整数値ではありません: {values['price']}")
+            return None
+        return (line, format_product_name(values['name']), amount, price,
+                values['shop'], format_shop_branch(values['shop_branch']))
+
+    def stream(self, records):
+        """商品情報を検証し、COPYに渡すCSVの行に変換します。
+
+        Args:
+            records (iterator[tuple[int, dict]]): 行番号と商品情報。
+
+        Yields:
+            str: CSVの行。
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for line, record in records:
+            row = self.validate(line, record)
+            if row is None:
+                continue
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    def run(self, path, format_=None):
+        """ファイルの商品情報をデータベースに登録します。
+
+        Args:
+            path (str or Path): ファイルのパス。
+            format_ (str, optional): 'csv'または'jsonl'。
+                省略した場合は拡張子から判断します。
+
+        Returns:
+            dict: 件数。 inserted(新規登録), updated(価格を更新),
+                duplicated(ファイル内の重複), rejected(登録しなかった行)。
+        """
+        Schema.setup()
+        self.__rejects = []
+        counts = {}
+        with Database.cursor(True) as cursor:
+            cursor.execute("""
+                create temp table import_staging (
+                    line int, name text, amount numeric, price int,
+                    shop text, shop_branch text
+                ) on commit drop
+            """)
+            cursor.copy_expert(
+                'copy import_staging from stdin with (format csv)',
+                CopyStream(self.stream(self.read(path, format_))))
+            cursor.execute("""
+                delete from import_staging as s
+                where char_length(s.name) >= 2
+                    and right(s.name, 2) not in ('本体', '詰替')
+                    and (exists (
+                        select 1 from products as p
+                        where p.name in (s.name || '詰替', s.name || '本体')
+                    ) or exists (
+                        select 1 from import_staging as t
+                        where t.name in (s.name || '詰替', s.name || '本体')
+                    ))
+                returning s.line, s.name
+            """)
+            for line, name in cursor.fetchall():
+                self.__reject(line, f'{name}は本体と詰替の区別が必要です。')
+            cursor.execute("""
+                delete from import_staging as a using import_staging as b
+                where a.name = b.name and a.amount = b.amount
+                    and a.shop = b.shop and a.shop_branch = b.shop_branch
+                    and a.line < b.line
+            """)
+            counts['duplicated'] = cursor.rowcount
+            cursor.execute("""
+                insert into products (name, amount, price, shop, shop_branch)
+                select name, amount, price, shop, shop_branch
+                from import_staging
+                on conflict (name, amount, shop, shop_branch)
+                do update set price = excluded.price
+                returning name, xmax = 0
+            """)
+            written = cursor.fetchall()
+            inserted = [x[1] for x in written]
+            counts['inserted'] = inserted.count(True)
+            counts['updated'] = inserted.count(False)
+            if written:
+                Catalog.bump(cursor, (x[0] for x in written))
+                Catalog.summarize(cursor, (x[0] for x in written))
+        counts['rejected'] = len(self.__rejects)
+        return counts
+
+    @property
+    def rejects(self):
+        """登録しなかった行の行番号と理由です。
+
+        Returns:
+            list[tuple[int, str]]: 行番号と理由。
+        """
+        return sorted(self.__rejects)
+
+
+def main(argv=None):
+    """コマンドラインから商品情報を登録します。
+
+        python -m inner.importer products.csv
+        python -m inner.importer flyer.jsonl --format jsonl
+
+    Args:
+        argv (list[str], optional): コマンドライン引数。
+
+    Returns:
+        int: 終了コード。
+    """
+    parser = argparse.ArgumentParser(description='商品情報をまとめて登録します。')
+    parser.add_argument('path', help='CSVまたはJSONLのファイル')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), dest='format_')
+    args = parser.parse_args(argv)
+    importer = Importer()
+    counts = importer.run(args.path, args.format_)
+    for line, reason in importer.rejects:
+        print(f'{args.path}:{line}: {reason}', file=sys.stderr)
+    print(', '.join(f'{key}: {value}' for key, value in counts.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,65 +1,194 @@
 import base64
+import os
 import pickle
+import threading
+import time
 from pathlib import Path
+from types import MappingProxyType
 
 
 class Loader:
     """外部ファイルから必要なデータを読み込むためのクラスです。
 
+    各ファイルは一度だけ読み込んで解析し、変更できない形で保持します。
+    保持しているデータは、ファイルの更新日時が変わっていれば読み込み直されるため、再起動せずに文言を変更できます。
+    更新日時の確認はRELOAD_INTERVAL秒に一度だけ行います。
+
     このクラスはインスタンスを必要としません。
 
+    以下の環境変数で設定を変更できます。
+        DICS_RELOAD: 更新日時を確認する間隔の秒数。 標準は5秒です。
+
     Returns:
         str: load_uri。
-        list[dict]: load_action, load_add_responses。
+        tuple[MappingProxyType]: load_action, load_add_responses。
+        tuple[str]: load_add_keys。
+        MappingProxyType: load_add_response_table。
     """
     PATH = Path('inner', 'dics')
     PATTERN = PATH / 'pattern.txt'
     URI = PATH / 'uri.txt'
+    RELOAD_INTERVAL = float(os.getenv('DICS_RELOAD', 5))
+    __cache = {}
+    __built = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def __read(cls, path, parser):
+        """ファイルを解析した結果を返します。
+        前回の読み込みから更新されていなければ保持している結果を返します。
+
+        Args:
+            path (Path): ファイルのパス。
+            parser (func): ファイルオブジェクトを受け取り、解析結果を返す関数。
+
+        Returns:
+            any: 解析結果。
+        """
+        now = time.monotonic()
+        entry = cls.__cache.get(path)
+        if entry is not None and now - entry[1] < cls.RELOAD_INTERVAL:
+            return entry[2]
+        with cls.__lock:
+            entry = cls.__cache.get(path)
+            mtime = os.stat(path).st_mtime_ns
+            if entry is None or entry[0] != mtime:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = parser(f)
+            else:
+                data = entry[2]
+            cls.__cache[path] = (mtime, now, data)
+            return data
+
+    @staticmethod
+    def __parse_patterns(f):
+        """パターン定義ファイルを解析し、モード毎の定義に分けます。
+
+        Args:
+            f (TextIO): パターン定義ファイル。
+
+        Returns:
+            dict[str, tuple[tuple[str, str]]]: モード毎の(pattern, status)の組。
+        """
+        data = {}
+        for line in f:
+            if not line.strip():
+                continue
+            type_, pattern, status = (x.strip() for x in line.split('\t'))
+            status = str(status).replace('\\n', '\n')
+            data.setdefault(type_, []).append((pattern, status))
+        return {mode: tuple(pairs) for mode, pairs in data.items()}
+
+    @staticmethod
+    def __parse_uri(f):
+        """データベースに接続するための情報を復元します。
+
+        Args:
+            f (TextIO): 接続情報ファイル。
+
+        Returns:
+            str: データベースに接続するための情報。
+        """
+        return pickle.loads(base64.b64decode(f.read()))
+
+    @classmethod
+    def __load(cls, mode):
+        """パターン定義ファイルから指定モードの(pattern, status)の組を読み込みます。
+
+        Args:
+            mode (str): 読み込むパターン名。
+
+        Returns:
+            tuple[tuple[str, str]]: パターン定義データ。
+        """
+        return cls.__read(cls.PATTERN, cls.__parse_patterns).get(mode, ())
 
     @classmethod
-    def __load(cls, mode, is_unique=False):
-        """パターン定義ファイルから指定モードのデータを読み込みます。
-        is_uniqueを指定すると、[{pattern: status}, {...}, ...]となります。
-        標準では[{'pattern': pattern, 'status': status}, {...}, ...]となります。
+    def __freeze(cls, mode, builder):
+        """指定モードのパターン定義から組み立てた変更できないデータを返します。
+        組み立てた結果は元の定義が読み込み直されるまで使い回します。
 
         Args:
             mode (str): 読み込むパターン名。
-            is_unique (bool, optional): リストに格納される辞書の形式が固有の物になります。
+            builder (func): パターン定義データを受け取り、変換する関数。
 
         Returns:
-            list[dict]: パターン定義データ。
+            any: 組み立てた結果。
+        """
+        pairs = cls.__load(mode)
+        key = (mode, builder)
+        entry = cls.__built.get(key)
+        if entry is None or entry[0] is not pairs:
+            entry = (pairs, builder(pairs))
+            cls.__built[key] = entry
+        return entry[1]
+
+    @staticmethod
+    def __build_action(pairs):
+        """load_actionの形式に変換します。
+        """
+        return tuple(
+            MappingProxyType({
+                'pattern': pattern,
+                'status': status
+            }) for pattern, status in pairs)
+
+    @staticmethod
+    def __build_add_responses(pairs):
+        """load_add_responsesの形式に変換します。
+        """
+        return tuple(
+            MappingProxyType({pattern: status}) for pattern, status in pairs)
+
+    @staticmethod
+    def __build_add_keys(pairs):
+        """load_add_keysの形式に変換します。
         """
-        data = []
-        with open(cls.PATTERN, 'r', encoding='utf-8') as f:
-            for line in f:
-                if not line:
-                    continue
-                type_, pattern, status = (x.strip() for x in line.split('\t'))
-                if type_ == mode:
-                    status = str(status).replace('\\n', '\n')
-                    if is_unique:
-                        data.append({pattern: status})
-                    else:
-                        data.append({'pattern': pattern, 'status': status})
-        return data
+        return tuple(pattern for pattern, _ in pairs)
+
+    @staticmethod
+    def __build_add_response_table(pairs):
+        """load_add_response_tableの形式に変換します。
+        """
+        return MappingProxyType(dict(pairs))
 
     @classmethod
     def load_action(cls):
-        """AIの行動を定義する辞書オブジェクトが纏められたリストを読み込みます。
+        """AIの行動を定義する辞書オブジェクトが纏められたタプルを読み込みます。
+        辞書は{'pattern': pattern, 'status': status}の形式です。
 
         Returns:
-            list[dict]: AIの行動を定義する辞書オブジェクトが纏められたリスト。
+            tuple[MappingProxyType]: AIの行動を定義する辞書オブジェクトが纏められたタプル。
         """
-        return cls.__load('action')
+        return cls.__freeze('action', cls.__build_action)
 
     @classmethod
     def load_add_responses(cls):
         """AddResponder用の定義群を読み込みます。
+        辞書は{key: response}の形式です。
+
+        Returns:
+            tuple[MappingProxyType]: AddResponder用の定義群。
+        """
+        return cls.__freeze('add_responses', cls.__build_add_responses)
+
+    @classmethod
+    def load_add_keys(cls):
+        """AddResponderのstateに設定するキー群を定義順に読み込みます。
+
+        Returns:
+            tuple[str]: AddResponder用のキー群。
+        """
+        return cls.__freeze('add_responses', cls.__build_add_keys)
+
+    @classmethod
+    def load_add_response_table(cls):
+        """AddResponderのstate毎の応答パターンを読み込みます。
 
         Returns:
-            list[dict]: AddResponder用の定義群。
+            MappingProxyType: キーがstate、値が応答パターンの辞書。
         """
-        return cls.__load('add_responses', True)
+        return cls.__freeze('add_responses', cls.__build_add_response_table)
 
     @classmethod
     def load_uri(cls):
@@ -68,8 +197,7 @@ class Loader:
         Returns:
             str: データベースに接続するための情報。
         """
-        with open(cls.URI, 'r', encoding='utf-8') as f:
-            return pickle.loads(base64.b64decode(f.read()))
+        return cls.__read(cls.URI, cls.__parse_uri)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,141 @@
+import re
+
+LITERALS = re.compile(r'\^\(((?:[^\\()\[\]{}.*+?|^$]+\|)*'
+                      r'[^\\()\[\]{}.*+?|^$]+)\)')
+
+
+class ActionMatcher:
+    """アクションの反応パターン群を正規表現にまとめ、少ない照合でstatusを判定します。
+
+    '^'で始まる(文字列の先頭に固定された)パターンは、名前付きグループの選択肢として
+    一つの'\\A(?:...)'にまとめ、文字列の先頭で一度だけ照合します。
+    '^(登録|追加|add)'のように語句を並べただけのパターンは、語句の木(trie)の形に書き換えてからまとめるため、
+    語句が増えても照合の時間はほとんど増えません。
+    それ以外のパターンは個別にコンパイルし、re.searchで照合します。
+    照合はパターンの定義順に行うため、パターンを先頭から順にre.searchした場合と同じく、
+    先に定義されたパターンが優先されます。
+
+    '^'で始まるパターンは、'^(a|b)'のように全体を先頭に固定してください。
+    また、パターン内で番号による後方参照を使うと結合後に番号がずれるため、使用しないでください。
+
+    Attributes:
+        patterns (tuple[re.Pattern]): 照合する順のコンパイル済みの正規表現。
+    """
+    GROUP = '_action{}'
+
+    def __init__(self, actions):
+        """反応パターン群を結合し、コンパイルします。
+
+        Args:
+            actions (list[dict]): Loader.load_actionの形式の反応パターン群。
+        """
+        self.__statuses = {}
+        self.__steps = []
+        anchored = []
+        for i, action in enumerate(actions):
+            if action['pattern'].startswith('^'):
+                group = self.GROUP.format(i)
+                self.__statuses[group] = action['status']
+                anchored.append(f"(?P<{group}>{self.trie(action['pattern'])})")
+                continue
+            self.__combine(anchored)
+            self.__steps.append(
+                (re.compile(action['pattern']).search, action['status']))
+        self.__combine(anchored)
+
+    @staticmethod
+    def trie(pattern):
+        """'^(語句|語句|...)'の形のパターンを、語句の木(trie)の形の同じ意味の正規表現に書き換えます。
+        末尾は固定しないため、他の語句で始まる語句は取り除きます。
+        それ以外の形のパターンはそのまま返します。
+
+        Examples:
+            >>> ActionMatcher.trie('^(add|added|all|登録)')
+            '(?:a(?:dd|ll)|登録)'
+            >>> ActionMatcher.trie('^(取り?消し?)')
+            '^(取り?消し?)'
+
+        Args:
+            pattern (str): パターン。
+
+        Returns:
+            str: 書き換えた正規表現。
+        """
+        literals = LITERALS.fullmatch(pattern)
+        if literals is None:
+            return pattern
+        root = {}
+        for word in sorted(literals.group(1).split('|'), key=len):
+            node = root
+            for char in word:
+                if node.get('') is not None:
+                    break
+                node = node.setdefault(char, {})
+            else:
+                node.clear()
+                node[''] = True
+
+        def render(node):
+            if '' in node:
+                return ''
+            branches = [
+                re.escape(char) + render(child)
+                for char, child in sorted(node.items())
+            ]
+            if len(branches) == 1:
+                return branches[0]
+            return '(?:' + '|'.join(branches) + ')'
+
+        return render(root)
+
+    def __combine(self, anchored):
+        """溜めておいた先頭に固定されたパターン群を一つの正規表現にまとめ、照合の手順に加えます。
+
+        Args:
+            anchored (list[str]): 名前付きグループにしたパターン群。 加えた後は空にします。
+        """
+        if anchored:
+            regex = re.compile(r'\A(?:' + '|'.join(anchored) + ')')
+            self.__steps.append((regex.match, None))
+            anchored.clear()
+
+    def classify(self, text):
+        """文字列に一致する反応パターンのstatusを返します。
+
+        Examples:
+            >>> matcher = ActionMatcher([
+            ...     {'pattern': '^(add)', 'status': 'add'},
+            ...     {'pattern': 'a.+b', 'status': 'ab'},
+            ...     {'pattern': '^(ab)', 'status': 'later'},
+            ... ])
+            >>> matcher.classify('add')
+            'add'
+            >>> matcher.classify('xaab')
+            'ab'
+            >>> str(matcher.classify('milk'))
+            'None'
+
+        Args:
+            text (str): 文字列。
+
+        Returns:
+            str or None: 一致したパターンのstatus。一致しなければNone。
+        """
+        for match, status in self.__steps:
+            matcher = match(text)
+            if matcher is not None:
+                return status or self.__statuses[matcher.lastgroup]
+        return None
+
+    @property
+    def patterns(self):
+        """照合する順のコンパイル済みの正規表現です。
+
+        Returns:
+            tuple[re.Pattern]: 正規表現。
+        """
+        return tuple(match.__self__ for match, _ in self.__steps)
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
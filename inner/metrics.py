@@ -0,0 +1,259 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+def _escape(value):
+    """ラベルの値をPrometheusのテキスト形式で使えるように変換します。
+    """
+    return str(value).replace('\\',
+                              '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    """ラベルをPrometheusのテキスト形式に変換します。
+
+    Examples:
+        >>> _labels(('stage', ), ('verify', ), 'le="0.1"')
+        '{stage="verify",le="0.1"}'
+        >>> _labels((), ())
+        ''
+    """
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """計測値の基底クラスです。
+    ラベルの値の組毎に計測値を保持します。
+
+    Attributes:
+        name (str): 計測値の名前。
+        help (str): 計測値の説明。
+        labels (tuple[str]): ラベルの名前。
+    """
+    TYPE = 'untyped'
+
+    def __init__(self, name, help_, labels=()):
+        """初期化します。
+
+        Args:
+            name (str): 計測値の名前。
+            help_ (str): 計測値の説明。
+            labels (tuple[str], optional): ラベルの名前。
+        """
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        """ラベルの辞書を、計測値を保持するためのキーに変換します。
+
+        Args:
+            labels (dict): ラベルの名前と値。
+
+        Returns:
+            tuple: ラベルの値の組。
+        """
+        return tuple(labels.get(x, '') for x in self.labels)
+
+    def render(self):
+        """Prometheusのテキスト形式に変換します。
+
+        Returns:
+            list[str]: 出力する行。
+        """
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.TYPE}',
+        ]
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        """ラベルの値の組一つ分をテキスト形式に変換します。
+        子クラスにて独自定義してください。
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """増加し続ける計測値です。
+    """
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """計測値を増やします。
+
+        Args:
+            amount (int or float, optional): 増やす値。
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_value(self, key, value):
+        return [f'{self.name}{_labels(self.labels, key)} {value}']
+
+
+class Gauge(Metric):
+    """出力時に関数を呼び出して値を求める計測値です。
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, help_, function=None):
+        """初期化します。
+
+        Args:
+            name (str): 計測値の名前。
+            help_ (str): 計測値の説明。
+            function (func, optional): 値を返す関数。
+        """
+        super().__init__(name, help_)
+        self.function = function
+
+    def render(self):
+        if self.function is None:
+            return []
+        with self.lock:
+            self.values = {(): self.function()}
+        return super().render()
+
+    def render_value(self, key, value):
+        return [f'{self.name} {value}']
+
+
+class Histogram(Metric):
+    """値の分布を区間毎の件数として保持する計測値です。
+    """
+    TYPE = 'histogram'
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10)
+
+    def __init__(self, name, help_, labels=(), buckets=BUCKETS):
+        """初期化します。
+
+        Args:
+            name (str): 計測値の名前。
+            help_ (str): 計測値の説明。
+            labels (tuple[str], optional): ラベルの名前。
+            buckets (tuple[float], optional): 区間の上限。
+        """
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """値を記録します。
+
+        Args:
+            value (float): 記録する値。
+        """
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ブロックの実行にかかった秒数を記録します。
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), counts):
+            cumulative += count
+            labels = _labels(self.labels, key, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _labels(self.labels, key)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Metrics:
+    """プロセス内の計測値を登録し、Prometheusのテキスト形式で出力するためのクラスです。
+
+    計測値の記録は区間の探索と加算だけで、出力するまで集計は行いません。
+    このクラスはインスタンスを必要としません。
+    """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+    STAGE_SECONDS = Histogram(
+        'linebot_stage_seconds',
+        'Time spent in each stage of handling a message.', ('stage', ))
+    __metrics = {STAGE_SECONDS.name: STAGE_SECONDS}
+    __lock = threading.Lock()
+
+    @classmethod
+    def __register(cls, metric):
+        """計測値を登録します。 同じ名前の計測値が登録済みであればそれを返します。
+        """
+        with cls.__lock:
+            return cls.__metrics.setdefault(metric.name, metric)
+
+    @classmethod
+    def counter(cls, name, help_, labels=()):
+        """Counterを登録して返します。
+        """
+        return cls.__register(Counter(name, help_, labels))
+
+    @classmethod
+    def gauge(cls, name, help_, function=None):
+        """Gaugeを登録して返します。
+        """
+        return cls.__register(Gauge(name, help_, function))
+
+    @classmethod
+    def histogram(cls, name, help_, labels=(), buckets=Histogram.BUCKETS):
+        """Histogramを登録して返します。
+        """
+        return cls.__register(Histogram(name, help_, labels, buckets))
+
+    @classmethod
+    def stage(cls, stage):
+        """処理の段階の所要時間をlinebot_stage_secondsに記録します。
+
+            with Metrics.stage('verify'):
+                ...
+
+        Args:
+            stage (str): 段階の名前。
+
+        Returns:
+            contextmanager: 所要時間を記録するコンテキストマネージャ。
+        """
+        return cls.STAGE_SECONDS.time(stage=stage)
+
+    @classmethod
+    def render(cls):
+        """登録されている全ての計測値をPrometheusのテキスト形式で返します。
+
+        Returns:
+            str: 計測値。
+        """
+        lines = []
+        for metric in list(cls.__metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
@@ -0,0 +1,138 @@
+import threading
+import unicodedata
+
+KATAKANA_TO_HIRAGANA = {x: x - 0x60 for x in range(ord('ァ'), ord('ヶ') + 1)}
+
+
+def normalize(text):
+    """表記揺れを吸収するため、文字列を正規化します。
+    NFKCで全角半角を揃え、英字を小文字に、カタカナをひらがなに変換し、空白を取り除きます。
+
+    Examples:
+        >>> normalize('ボディソープ') == normalize('ぼでぃそーぷ')
+        True
+        >>> normalize('ｼｬﾝﾌﾟｰ Ｍｉｌｋ')
+        'しゃんぷーmilk'
+
+    Args:
+        text (str): 文字列。
+
+    Returns:
+        str: 正規化した文字列。
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ''.join(text.translate(KATAKANA_TO_HIRAGANA).split())
+
+
+def ngrams(text, n=2):
+    """正規化済みの文字列を前後に区切りを付けてn文字ずつに分割します。
+
+    Examples:
+        >>> sorted(ngrams('ぎゅう'))
+        ['\\x00ぎ', 'う\\x00', 'ぎゅ', 'ゅう']
+
+    Args:
+        text (str): 正規化済みの文字列。
+        n (int, optional): 分割する文字数。
+
+    Returns:
+        frozenset[str]: n文字の組。
+    """
+    text = '\0' + text + '\0'
+    return frozenset(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+class NgramIndex:
+    """商品名をn文字の組で引く転置索引です。
+    商品名は正規化してから分割するため、カタカナとひらがな、全角と半角の違いを区別しません。
+
+    一致度は、検索する文字列の組のうち商品名に含まれる割合(被覆率)と、組の一致度(Dice係数)の大きい方です。
+    被覆率は商品名の一部だけを入力した場合を、Dice係数は商品名に余分な語句を付けて入力した場合を拾います。
+    2文字以上の文字列は、それを含む商品名に対して必ず1/3以上の被覆率になります。
+    検索結果は一致度の高い順に返します。
+    追加, 削除は検索と並行して行えます。
+    """
+    def __init__(self, names=(), n=2):
+        """索引を作ります。
+
+        Args:
+            names (iterable[str], optional): 索引に加える商品名。
+            n (int, optional): 分割する文字数。
+        """
+        self.__n = n
+        self.__postings = {}
+        self.__grams = {}
+        self.__lock = threading.Lock()
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.__grams)
+
+    def add(self, name):
+        """商品名を索引に加えます。
+
+        Args:
+            name (str): 商品名。
+        """
+        grams = ngrams(normalize(name), self.__n)
+        with self.__lock:
+            if name in self.__grams:
+                return
+            self.__grams[name] = grams
+            for gram in grams:
+                self.__postings.setdefault(gram, set()).add(name)
+
+    def discard(self, name):
+        """商品名を索引から取り除きます。
+
+        Args:
+            name (str): 商品名。
+        """
+        with self.__lock:
+            grams = self.__grams.pop(name, ())
+            for gram in grams:
+                names = self.__postings[gram]
+                names.discard(name)
+                if not names:
+                    del self.__postings[gram]
+
+    def search(self, text, limit=10, threshold=0.3):
+        """文字列に似た商品名を一致度の高い順に返します。
+
+        Examples:
+            >>> index = NgramIndex(['ボディソープ', 'ボディソープ詰替', 'シャンプー'])
+            >>> [name for name, _ in index.search('ぼでぃそーぷ')]
+            ['ボディソープ', 'ボディソープ詰替']
+            >>> NgramIndex(['ロースハムスライス']).search('ハム')
+            [('ロースハムスライス', 0.3333333333333333)]
+            >>> NgramIndex(['おいしい牛乳1000ml', '牛乳']).search('牛乳')
+            [('牛乳', 1.0), ('おいしい牛乳1000ml', 0.3333333333333333)]
+            >>> NgramIndex(['牛乳']).search('おいしい牛乳')
+            [('牛乳', 0.4)]
+
+        Args:
+            text (str): 検索する文字列。
+            limit (int, optional): 返す件数の上限。
+            threshold (float, optional): 返す一致度の下限。
+
+        Returns:
+            list[tuple[str, float]]: 商品名と一致度の組。
+        """
+        grams = ngrams(normalize(text), self.__n)
+        counts = {}
+        with self.__lock:
+            for gram in grams:
+                for name in self.__postings.get(gram, ()):
+                    counts[name] = counts.get(name, 0) + 1
+            scores = [(name,
+                       max(count / len(grams),
+                           2 * count / (len(grams) + len(self.__grams[name]))))
+                      for name, count in counts.items()]
+        scores = [x for x in scores if x[1] >= threshold]
+        scores.sort(key=lambda x: (-x[1], x[0]))
+        return scores[:limit]
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
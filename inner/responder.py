@@ -1,372 +1,635 @@
-import re
-
-import psycopg2
-
-from inner.funcs import generate_words, text_to_value
+import os
+
+from inner.cache import LRUCache
+from inner.catalog import Catalog
+from inner.database import Database
+from inner.funcs import (format_product_name, format_shop_branch,
+                         need_distinction, text_to_value)
+from inner.importer import Importer
 from inner.loader import Loader
+from inner.ngram import normalize
 
 
-class Responder:
-    """AIの応答を制御する思考エンジンの基底クラスです。
+class ResponderState:
+    """ユーザー毎の会話状態です。
+    振舞いは持たず、engineで指定した全ユーザーで共有するレスポンダが処理します。
+
+    小さな値だけを保持するため、多数のユーザー分を保持したり、pickleで保存して後から再開したりできます。
+    responseとexitはレスポンダに委譲するため、従来のレスポンダと同じように扱えます。
 
     Attributes:
+        engine (str): 処理するレスポンダの名前です。 Responder.enginesのキーです。
         state (int or str): 実行状態を表します。
-            0が初期化直後で、処理を完了し不要になった状態を"end"としてください。
-        connection(psycopg2.connect): データベースとの接続です。
-        cursor(connect.cursor): カーソルです。
+            0が初期化直後で、処理を完了し不要になった状態が"end"です。
+        info (dict or None): 登録中の商品情報です。
+        guess (tuple[str] or None): 番号で選べる商品名です。
+        offset (int): guessの最初の商品名の番号です。
+        page (dict or None): 商品一覧の次のページの位置です。
+        adder (ResponderState or None): 商品情報を登録する会話状態です。
     """
-    def __create_cursor(self, commit=False):
-        """データベースの接続とカーソルを用意します。
+    __slots__ = ('engine', 'state', 'info', 'guess', 'offset', 'page', 'adder')
 
-        Args:
-            commit (bool, optional): sqlを発行した際、データベースに結果を反映するかどうか。 標準では反映させません。
-        """
-        self.__connection = psycopg2.connect(Loader.load_uri())
-        self.__connection.autocommit = commit
-        self.__cursor = self.__connection.cursor()
-
-    def __init__(self):
+    def __init__(self, engine):
         """初期化します。
+
+        Args:
+            engine (str): 処理するレスポンダの名前。
         """
-        self.__state = 0
-        self.__create_cursor(True)
+        self.engine = engine
+        self.state = 0
+        self.info = None
+        self.guess = None
+        self.offset = 0
+        self.page = None
+        self.adder = None
 
     def end(self):
         """現在の実行状態を'end'に設定します。
         """
-        self.__state = 'end'
+        self.state = 'end'
 
     def exit(self):
-        """終了処理を行います。
+        """レスポンダの終了処理を行います。
         """
-        self.cursor.close()
-        self.connection.close()
+        Responder.engines[self.engine].exit(self)
 
     def response(self, text):
-        """AIの応答を生成し、返します。
-        子クラスにて独自定義してください。
+        """レスポンダの応答を返します。
 
         Args:
             text (str): ユーザーからの入力。
+
+        Returns:
+            str: AIからの応答。
         """
-        raise NotImplementedError
+        return Responder.engines[self.engine].response(self, text)
 
-    @property
-    def connection(self):
-        """データベースの接続です。
+
+class Responder:
+    """AIの応答を制御する思考エンジンの基底クラスです。
+
+    会話状態はResponderStateとして分けて持ち、レスポンダ自身は状態を持ちません。
+    インスタンスはenginesに一つずつ登録され、全ユーザーで共有されます。
+    データベースとの接続は保持せず、sqlを発行する間だけDatabaseから借ります。
+
+    Attributes:
+        NAME (str): レスポンダの名前です。 ResponderState.engineに記録されます。
+        engines (dict[str, Responder]): 共有するレスポンダです。
+    """
+    NAME = None
+    engines = {}
+
+    @classmethod
+    def shared(cls):
+        """全ユーザーで共有するインスタンスを返します。
 
         Returns:
-            psycopg2.connect: データベースの接続。
+            Responder: レスポンダ。
         """
-        return self.__connection
+        return Responder.engines[cls.NAME]
 
-    @property
-    def cursor(self):
-        """sqlの発行を行い、結果を格納します。
+    def start(self):
+        """新しい会話状態を返します。
 
         Returns:
-            connect.cursor: カーソル。
+            ResponderState: 会話状態。
         """
-        return self.__cursor
+        return ResponderState(self.NAME)
 
-    @property
-    def state(self):
-        """現在の実行状態です。
-        0, 'end' 以外の状態は独自に設定可能です。
+    def exit(self, session):
+        """終了処理を行います。
+        接続はsqlの発行毎にプールへ返却しているため、子クラスで資源を持つ場合に定義してください。
+
+        Args:
+            session (ResponderState): 会話状態。
+        """
+
+    def fetch(self, sql, vars=None):
+        """sqlを発行し、結果を全て返します。
+
+        Args:
+            sql (str): 発行するsql。
+            vars (tuple or dict, optional): sqlに埋め込む値。
 
         Returns:
-            int or str: 現在の実行状態。
+            list[tuple]: 結果。
         """
-        return self.__state
+        with Database.cursor() as cursor:
+            cursor.execute(sql, vars)
+            return cursor.fetchall()
 
-    @state.setter
-    def state(self, value):
-        """現在の実行状態を設定します。
-        0, 'end'を指定することはできません。
+    def response(self, session, text):
+        """AIの応答を生成し、返します。
+        子クラスにて独自定義してください。
 
         Args:
-            value (int or str): 現在の実行状態。
+            session (ResponderState): 会話状態。
+            text (str): ユーザーからの入力。
         """
-        if value in (0, 'end'):
-            raise ValueError
-        self.__state = value
+        raise NotImplementedError
 
 
 class AddResponder(Responder):
     """商品情報を追加するためのレスポンダです。
 
+    会話状態のinfoに商品情報を、stateに登録の進捗を記録します。
+
     Attributes:
         keys (tuple[str]): stateに設定するキー群です。 これを使って商品登録の進捗を制御します。
-        info: 商品情報の辞書です。
-        values(tuple[any]): 商品情報のタプルです。
         responses(dict): 応答パターンです。
+        UPSERT_SQL (str): 商品情報を登録し、Catalogの版数を進めて変更した商品名を記録するsqlです。
+            商品名、分量、店、支店名が同じ商品が存在する場合は価格を更新します。
+            "本体"あるいは"詰替"の区別が必要な場合は何もせず、行を返しません。
+    """
+    NAME = 'add'
+    UPSERT_SQL = """
+        with upsert as (
+            insert into products (name, amount, price, shop, shop_branch)
+            select %(name)s, %(amount)s, %(price)s, %(shop)s, %(shop_branch)s
+            where not %(check)s or not exists (
+                select 1 from products
+                where name in (%(name)s || '詰替', %(name)s || '本体'))
+            on conflict (name, amount, shop, shop_branch)
+            do update set price = excluded.price
+            returning 1
+        ), bumped as (
+            update catalog_version set version = version + 1
+            where id = 1 and exists (select 1 from upsert)
+            returning version
+        ), logged as (
+            insert into catalog_changes (version, name)
+            select version, %(name)s from bumped
+        ), pruned as (
+            delete from catalog_changes
+            where version <= (select version from bumped) - %(retention)s
+        )
+        select version from bumped
     """
-    def __init__(self, **kwargs):
-        """商品情報を追加します。
+
+    def start(self, **kwargs):
+        """商品情報を追加する会話状態を返します。
         キーワード引数でname, amount, price, shop, shop_branchを適切に設定することで商品登録を簡略化することができます。
-        """
-        super().__init__()
-        self.__load()
-        self.__infomation = {x: False for x in self.keys}
-        if kwargs:
-            catch_keys = ('name', 'amount', 'price', 'shop', 'shop_branch')
-            for key in kwargs:
-                if key not in catch_keys:
-                    del kwargs[key]
-            while kwargs:
-                self.update_state()
-                state = self.state
-                data = kwargs[state]
-                self.store_infomation_value(data)
-                del kwargs[state]
-
-    def __load(self):
-        """反応する文字列パターンを読み込みます。
-        また、設定に必要なキー群を読み込み設定します。
-        """
-        patterns = Loader.load_add_responses()
-        self.__keys = []
-        self.__responses = {}
-        for pattern in patterns:
-            for key in pattern:
-                self.__keys.append(key)
-                self.__responses[key] = pattern[key]
-
-    def add_infomation(self, text):
+
+        Returns:
+            ResponderState: 会話状態。
+        """
+        session = super().start()
+        session.info = {x: False for x in self.keys}
+        catch_keys = ('name', 'amount', 'price', 'shop', 'shop_branch')
+        kwargs = {k: v for k, v in kwargs.items() if k in catch_keys}
+        while kwargs:
+            self.update_state(session)
+            data = kwargs.pop(session.state)
+            self.store_infomation_value(session, data)
+        return session
+
+    def add_infomation(self, session, text):
         """文字列を受け取り、未設定の商品情報を登録していきます。
         また、次に必要な情報を促す文字列を返します。
 
         Args:
+            session (ResponderState): 会話状態。
             text (str): 文字列。
 
         Returns:
             str: 次に必要な情報を促す文字列。
         """
-        previous = self.state
-        self.update_state()
+        info = session.info
+        previous = session.state
+        self.update_state(session)
         if previous == 0:
-            return self.responses[self.state]
-        if self.state == 'has_refill':
+            return self.responses[session.state]
+        if session.state == 'has_refill':
             num = text_to_value(text, int)
             if num == 0:
-                self.info['name'] += "詰替"
+                info['name'] += "詰替"
             elif num == 1:
-                self.info['name'] += "本体"
+                info['name'] += "本体"
             else:
-                return self.responses[self.state].format(self.info['name'])
-            return self.commit()
-        self.store_infomation_value(text)
-        if self.info['confirm'] in ('ok', 'no'):
-            return self.commit()
-        if self.state == 'confirm':
-            return self.responses[self.state].format(*self.values)
-        return self.responses[self.state]
-
-    def commit(self):
+                return self.responses[session.state].format(info['name'])
+            return self.commit(session)
+        self.store_infomation_value(session, text)
+        if info['confirm'] in ('ok', 'no'):
+            return self.commit(session)
+        if session.state == 'confirm':
+            return self.responses[session.state].format(*self.values(session))
+        return self.responses[session.state]
+
+    def commit(self, session):
         """登録作業の完了を試みます。
-        無事登録できた場合、あるいは登録しなかった場合にはこのレスポンダは終了状態になります。
+        無事登録できた場合、あるいは登録しなかった場合には会話状態は終了状態になります。
         データベースに登録する作業に問題があった場合は処理が継続します。
 
+        Args:
+            session (ResponderState): 会話状態。
+
         Returns:
             str: 結果を表示する文字列。
         """
-        if self.info['confirm'] == 'ok':
-            if self.send_database():
+        if session.info['confirm'] == 'ok':
+            if self.send_database(session):
                 res = "登録しました。"
             else:
-                self.state = 'has_refill'
-                return self.responses[self.state].format(self.info['name'])
+                session.state = 'has_refill'
+                return self.responses[session.state].format(
+                    session.info['name'])
         else:
             res = "登録を取り消しました。"
-        self.end()
+        session.end()
         return res
 
-    def delete_database(self):
-        """データベースから商品名、分量、店、支店が一致する商品の削除を行います。
-        分量が小数点の場合、近似値を削除します。
-        """
-        name = self.info['name']
-        amount = self.info['amount']
-        shop = self.info['shop']
-        shop_branch = self.info['shop_branch']
-        sql = "delete from products where name='{}' and {} and shop='{}' and shop_branch='{}'"
-        if type(amount) is int:
-            del_data = (name, f'amount={amount}', shop, shop_branch)
-        elif type(amount) is float:
-            decimal_digit = len(str(amount).split('.')[1])
-            min_ = amount - float(f'0.{"0"*decimal_digit}1')
-            max_ = amount + float(f'0.{"0"*(decimal_digit-1)}1') - float(
-                f'0.{"0"*decimal_digit}1')
-            del_data = (name, f'amount between {min_} and {max_}', shop,
-                        shop_branch)
-        sql = sql.format(*del_data)
-        self.cursor.execute(sql)
-
-    def format_product_name(self):
+    def format_product_name(self, session):
         """商品名末尾に詰め替え、本体を表す語句がある場合適切な形式に置換します。
+
+        Args:
+            session (ResponderState): 会話状態。
         """
-        name = self.info['name']
-        name = re.sub('詰め?替え?', '詰替', name)
-        name = re.sub('つめかえ', '詰替', name)
-        name = re.sub('ほんたい', '本体', name)
-        self.info['name'] = name
+        session.info['name'] = format_product_name(session.info['name'])
 
-    def need_distinction(self):
-        """商品を登録する際、"本体"あるいは"詰替"という区別の追加が必要かどうかを返します。
+    def need_distinction(self, session):
+        """商品を登録する際、"本体"あるいは"詰替"という区別の追加が必要になり得るかどうかを返します。
         すでに商品名末尾が"本体"あるいは"詰替"である場合はFalseとして扱います。
+        実際に区別が必要かどうかは、登録時にUPSERT_SQLがデータベースを参照して判断します。
+
+        Args:
+            session (ResponderState): 会話状態。
 
         Returns:
-            bool: 区別の追加が必要かどうか。
+            bool: 区別の追加が必要になり得るかどうか。
         """
-        name = self.info['name']
-        if len(name) < 2:
-            return False
-        if name[-2:] in ('本体', '詰替'):
-            return False
-        if name[-4:] in ('ほんたい', 'つめかえ'):
-            return False
-        sql = f"select name from products where name ~ '{name}詰め?替え?$' or name ~ '{name}本体$'"
-        self.cursor.execute(sql)
-        return bool(self.cursor.fetchall())
+        return need_distinction(session.info['name'])
 
-    def response(self, text):
+    def response(self, session, text):
         """応答を生成し、返します。
         受け取った文字列に応じて、商品情報登録の進捗制御、返信の作成を行います。
 
         Args:
+            session (ResponderState): 会話状態。
             text (str): ユーザーからの入力。
 
         Returns:
             str: AIからの応答。
         """
-        res = self.add_infomation(text)
+        res = self.add_infomation(session, text)
         return res
 
-    def send_database(self):
+    def send_database(self, session):
         """完成した商品情報をデータベースに登録します。
         商品名、分量、店、支店名が同じ商品が存在する場合、今回の商品情報で更新されます。
-        """
-        self.format_product_name()
-        if self.need_distinction():
+        登録と商品名の要約の更新は一つのトランザクションで行い、登録後はCatalogにも反映されます。
+
+        Args:
+            session (ResponderState): 会話状態。
+
+        Returns:
+            bool: 登録できたかどうか。 本体、詰替の区別が必要な場合はFalseです。
+        """
+        self.format_product_name(session)
+        params = dict(
+            zip(('name', 'amount', 'price', 'shop', 'shop_branch'),
+                self.values(session)))
+        params['check'] = self.need_distinction(session)
+        params['retention'] = Catalog.RETENTION
+        with Database.cursor(True) as cursor:
+            cursor.execute(self.UPSERT_SQL, params)
+            row = cursor.fetchone()
+            if row is not None:
+                Catalog.summarize(cursor, (params['name'], ))
+        if row is None:
             return False
-        self.delete_database()
-        data = self.values
-        sql = f"insert into products values {data}"
-        self.cursor.execute(sql)
+        ProductResponder.invalidate({params['name']})
+        if Catalog.ENABLED:
+            Catalog.refresh({params['name']}, row[0])
         return True
 
-    def store_infomation_value(self, text):
+    def store_infomation_value(self, session, text):
         """文字列を受け取り、現在のstateに応じて商品情報を登録していきます。
         最後に、最新のstateに更新します。
 
         Args:
+            session (ResponderState): 会話状態。
             text (str): stateに応じた文字列。
         """
-        state = self.state
+        info = session.info
+        state = session.state
         if state == 'name':
             if text:
-                self.info['name'] = text
+                info['name'] = text
         elif state == 'amount':
             value = text_to_value(text)
             if value is not None:
-                self.info['amount'] = value
+                info['amount'] = value
         elif state == 'price':
             value = text_to_value(text, int)
             if value is not None:
-                self.info['price'] = value
+                info['price'] = value
         elif state == 'shop':
             if text:
-                self.info['shop'] = text
+                info['shop'] = text
         elif state == 'shop_branch':
             if text:
-                if text[-2:] == '支店':
-                    text = text[:-2]
-                elif text[-1] == '店':
-                    text = text[:-1]
-                self.info['shop_branch'] = text
+                info['shop_branch'] = format_shop_branch(text)
         elif state == 'confirm':
             ok_word = ('yes', 'y', 'はい')
             no_word = ('no', 'n', 'いいえ')
             if text:
                 text = text.lower()
                 if text in ok_word:
-                    self.info['confirm'] = 'ok'
+                    info['confirm'] = 'ok'
                 elif text in no_word:
-                    self.info['confirm'] = 'no'
-        self.update_state()
+                    info['confirm'] = 'no'
+        self.update_state(session)
 
-    def update_state(self):
+    def update_state(self, session):
         """現在の商品情報の完成度に応じてstateを更新します。
+
+        Args:
+            session (ResponderState): 会話状態。
         """
-        if self.state == 'has_refill':
+        if session.state == 'has_refill':
             return
-        if self.state == 0:
-            self.state = 'name'
+        if session.state == 0:
+            session.state = 'name'
             return
         for key in self.keys:
-            data = self.info[key]
+            data = session.info[key]
             if not data and data is not None:
-                self.state = key
+                session.state = key
                 return
 
-    @property
-    def info(self):
-        """商品情報を登録する辞書です。
+    def values(self, session):
+        """商品名, 分量, 価格, 店, 支店名の順のタプルを返します。
+
+        Args:
+            session (ResponderState): 会話状態。
 
         Returns:
-            dict: 商品情報。
+            tuple: 商品名, 分量, 価格, 店, 支店名。
         """
-        return self.__infomation
+        i = session.info
+        return (i['name'], i['amount'], i['price'], i['shop'],
+                i['shop_branch'])
 
     @property
     def keys(self):
         """商品名, 分量, 価格, 店, 支店名の順のキータプルを返します。
+        Loaderが保持している変更できないデータをそのまま参照します。
 
         Returns:
-            tuple: 商品名, 分量, 価格, 店, 支店名のキー。
+            tuple[str]: 商品名, 分量, 価格, 店, 支店名のキー。
         """
-        return self.__keys
+        return Loader.load_add_keys()
 
     @property
     def responses(self):
         """応答パターンの辞書です。
+        Loaderが保持している変更できないデータをそのまま参照します。
 
         Returns:
-            dict: 応答パターン。
+            MappingProxyType: 応答パターン。
         """
-        return self.__responses
+        return Loader.load_add_response_table()
 
-    @property
-    def values(self):
-        """商品名, 分量, 価格, 店, 支店名の順のタプルを返します。
+
+class BatchAddResponder(Responder):
+    """一度のメッセージで複数の商品情報をまとめて登録するレスポンダです。
+
+    メッセージは商品名, 分量, 価格, 店, 支店名の5行を1件として繰り返すか、
+    それらをタブで区切った1行を1件として並べます。 空行は読み飛ばします。
+    各項目はImporterと同じ規則で検証, 整形し、登録できない商品は理由と共に返信に含めます。
+    "本体"あるいは"詰替"の区別が必要な商品名は、同じメッセージ内の商品も含めて確認し、登録せずに1件ずつの登録を促します。
+
+    登録は一つのトランザクションで行い、問い合わせは区別の確認と登録の2回にまとめます。
+    メッセージ内で商品名, 分量, 店, 支店名が同じ商品は後のものを登録します。
+
+    Attributes:
+        DISTINCTION_SQL (str): 指定した商品名のうち、productsに存在するものを返すsqlです。
+        BATCH_UPSERT_SQL (str): 配列で受け取った商品情報をまとめて登録し、登録した行のキーと新規登録かどうかを返すsqlです。
+    """
+    NAME = 'batch'
+    DISTINCTION_SQL = 'select name from products where name = any(%(names)s)'
+    BATCH_UPSERT_SQL = """
+        insert into products (name, amount, price, shop, shop_branch)
+        select * from unnest(%(names)s::text[], %(amounts)s::numeric[],
+            %(prices)s::int[], %(shops)s::text[], %(shop_branches)s::text[])
+        on conflict (name, amount, shop, shop_branch)
+        do update set price = excluded.price
+        returning name, amount, shop, shop_branch, xmax = 0
+    """
+
+    @staticmethod
+    def split(text):
+        """メッセージを商品毎の項目に分けます。
+
+        Examples:
+            >>> BatchAddResponder.split('牛乳\\t1\\t198\\tスーパーA\\t駅前\\n\\n'
+            ...                         '卵\\n10\\n250\\nスーパーB\\n本店')
+            ... # doctest: +NORMALIZE_WHITESPACE
+            [['牛乳', '1', '198', 'スーパーA', '駅前'],
+             ['卵', '10', '250', 'スーパーB', '本店']]
+
+        Args:
+            text (str): メッセージ。
 
         Returns:
-            tuple: 商品名, 分量, 価格, 店, 支店名。
-        """
-        i = self.info
-        return (i['name'], i['amount'], i['price'], i['shop'],
-                i['shop_branch'])
+            list[list[str]]: 商品毎の項目。
+        """
+        records = []
+        lines = []
+        for line in text.split('\n'):
+            if '\t' in line:
+                records.append([x.strip() for x in line.split('\t')])
+            elif line.strip():
+                lines.append(line.strip())
+                if len(lines) == 5:
+                    records.append(lines)
+                    lines = []
+        if lines:
+            records.append(lines)
+        return records
+
+    def parse(self, text):
+        """メッセージを商品情報に変換します。
+
+        Args:
+            text (str): メッセージ。
+
+        Returns:
+            tuple[dict, list[tuple[int, str]]]: 登録する商品情報と、登録しない商品の番号と理由。
+                商品情報は(商品名, 分量, 店, 支店名)をキー、(番号, 商品名, 分量, 価格, 店, 支店名)を値とします。
+        """
+        importer = Importer()
+        rejects = []
+        items = {}
+        for number, fields in enumerate(self.split(text), 1):
+            if len(fields) != len(Importer.FIELDS):
+                rejects.append(
+                    (number, f'項目の数が{len(fields)}つです: {" ".join(fields)}'))
+                continue
+            row = importer.validate(number, dict(zip(Importer.FIELDS, fields)))
+            if row is not None:
+                items[(row[1], row[2], row[4], row[5])] = row
+        return items, rejects + importer.rejects
+
+    def response(self, session, text):
+        """商品情報を登録し、結果をまとめた文字列を返します。 会話状態は終了状態になります。
+
+        Args:
+            session (ResponderState): 会話状態。
+            text (str): ユーザーからの入力。
+
+        Returns:
+            str: 登録した商品と、登録しなかった商品の一覧。
+        """
+        items, rejects = self.parse(text)
+        written = self.send_database(items, rejects)
+        session.end()
+        lines = []
+        if written:
+            inserted = sum(1 for x in written if x[-1])
+            lines.append(f"{len(written)}件登録しました。"
+                         f"(新規: {inserted}件, "
+                         f"価格の更新: {len(written) - inserted}件)")
+            for _, name, amount, price, shop, branch in sorted(items.values()):
+                lines.append(f"・{name} {amount} {price}円 {shop} {branch}")
+        else:
+            lines.append("登録した商品はありません。")
+        if rejects:
+            lines.append(f"\n登録しなかった商品: {len(rejects)}件")
+            for number, reason in sorted(rejects):
+                lines.append(f"・{number}件目: {reason}")
+        return '\n'.join(lines)
+
+    def send_database(self, items, rejects):
+        """商品情報をまとめてデータベースに登録します。
+        区別が必要な商品はitemsから取り除き、rejectsに加えます。 登録後のitemsは全て登録した商品です。
+        登録と商品名の要約の更新は一つのトランザクションで行い、登録後はCatalogにも反映されます。
+
+        Args:
+            items (dict): parseが返した商品情報。
+            rejects (list[tuple[int, str]]): 登録しない商品の番号と理由。
+
+        Returns:
+            list[tuple]: 登録した行毎の(商品名, 分量, 店, 支店名, 新規登録かどうか)。
+        """
+        checked = {x[1] for x in items.values() if need_distinction(x[1])}
+        with Database.cursor(True) as cursor:
+            if checked:
+                cursor.execute(
+                    self.DISTINCTION_SQL,
+                    {'names': [x + y for x in checked for y in ('詰替', '本体')]})
+                distinct = {x[0][:-2] for x in cursor.fetchall()}
+                distinct.update(x[1][:-2] for x in items.values()
+                                if x[1][-2:] in ('詰替', '本体'))
+                for key, row in list(items.items()):
+                    if row[1] in distinct:
+                        rejects.append((row[0], f'{row[1]}は本体と詰替の区別が必要です。'
+                                        '1件ずつ登録してください。'))
+                        del items[key]
+            if not items:
+                return []
+            rows = list(zip(*(x[1:] for x in items.values())))
+            keys = ('names', 'amounts', 'prices', 'shops', 'shop_branches')
+            cursor.execute(self.BATCH_UPSERT_SQL,
+                           dict(zip(keys, map(list, rows))))
+            written = cursor.fetchall()
+            names = {x[0] for x in written}
+            version = Catalog.bump(cursor, names)
+            Catalog.summarize(cursor, names)
+        ProductResponder.invalidate(names)
+        if Catalog.ENABLED:
+            Catalog.refresh(names, version)
+        return written
 
 
 class ProductResponder(Responder):
     """商品情報を返すレスポンダです。
     データベースを参照し、単価が安い順番に並べて返します。
 
-    商品が見つからなかった場合に商品を登録するか確認し、AddResponderを生成、保持します。
-    また、AddResponderを保持している間はAddResponderとして振舞います。
+    商品が見つからなかった場合に商品を登録するか確認し、AddResponderの会話状態を生成、保持します。
+    また、AddResponderの会話状態を保持している間はAddResponderとして振舞います。
 
     ※AddResponderの保持、振舞いは未定義です。
     今後のバージョンアップで追加します。
 
+    会話状態のguessとoffsetに番号で選べる商品名を、pageに商品一覧の次のページの位置を記録します。
+
     Attributes
-    adder (AddResponder): 商品情報を追加するレスポンダです。
+    PREFIX_SQL (str): 文字列の先頭部分が最も長く一致する商品名を、一致した長さと共に返すsqlです。
+        長さkの先頭部分が一致すればそれより短い先頭部分も必ず一致するため、一致する長さを二分探索で求めます。
+        最初に3文字の先頭部分を調べ、一致すれば3文字以上の範囲を二分探索するため、
+        products_name_trgm索引を使える問い合わせだけで済み、回数も文字列の長さの対数に比例します。
+        一致しなければ2文字, 1文字の先頭部分を順に調べます。 この2回は索引を使えません。
+    RETRIEVE_SQL (str): 商品名の要約(product_summaries)から、単価の安い順の商品情報を返すsqlです。
+        主キーで1行を引くだけで、並べ替えは登録時に済んでいます。
+    LIST_SQL (str): 商品名の一覧の最初のページを返すsqlです。
+    LIST_AFTER_SQL (str): 商品名の一覧のうち、指定した商品名より後のページを返すsqlです。
+    NEXT_WORDS (tuple[str]): 商品一覧の次のページを表示する語句です。
+    PAGE_SIZE (int): 商品一覧の1ページに表示する商品名の数です。 環境変数SHOW_PAGE_SIZEで変更できます。 標準は30です。
+    GUESS_LIMIT (int): 商品名を推測する際に表示する候補の最大数です。
+    RESULTS (LRUCache): 商品名毎の整形済みの商品情報のキャッシュです。
+    CANDIDATES (LRUCache): 正規化した文字列毎の商品名の候補のキャッシュです。
+        どちらも環境変数RESULT_CACHE_SIZEで件数の上限(標準は1024件, 0で無効)を、
+        RESULT_CACHE_TTLで有効期限(標準は60秒)を変更できます。
     """
-    def __init__(self):
-        """商品情報を参照します。
-        """
-        super().__init__()
-        self.__adder: AddResponder = None
-        self.__guess = {}
+    NAME = 'product'
+    PREFIX_SQL = r"""
+        with recursive probes(found, missed) as (
+            select 0, char_length(%(text)s) + 1
+            union all
+            select case when h.hit then m.n else p.found end,
+                case when h.hit then p.missed else m.n end
+            from probes as p
+            cross join lateral (
+                select case
+                    when p.found >= 3 then (p.found + p.missed) / 2
+                    when p.missed > 3 then 3
+                    else p.missed - 1
+                end as n
+            ) as m
+            cross join lateral (
+                select exists (
+                    select 1 from products
+                    where name ilike '%%' || replace(replace(replace(
+                        left(%(text)s, m.n), '\', '\\'), '%%', '\%%'),
+                        '_', '\_') || '%%'
+                ) as hit
+            ) as h
+            where p.missed - p.found > 1
+        ), longest as (
+            select max(found) as n from probes
+        )
+        select distinct p.name, l.n as length
+        from longest as l join products as p
+            on p.name ilike '%%' || replace(replace(replace(
+                left(%(text)s, l.n), '\', '\\'), '%%', '\%%'),
+                '_', '\_') || '%%'
+        where l.n > 0
+    """
+    RETRIEVE_SQL = """
+        select s.name, e.amount, e.price, e.shop, e.shop_branch
+        from product_summaries as s,
+            unnest(s.amounts, s.prices, s.shops, s.shop_branches)
+                with ordinality as e(amount, price, shop, shop_branch, n)
+        where s.name = %(name)s
+        order by e.n
+    """
+    LIST_SQL = """
+        select distinct name collate "ja_JP.utf8" from products
+        order by 1 limit %(limit)s
+    """
+    LIST_AFTER_SQL = """
+        select distinct name collate "ja_JP.utf8" from products
+        where name collate "ja_JP.utf8" > %(after)s
+        order by 1 limit %(limit)s
+    """
+    NEXT_WORDS = ('次', 'つぎ', 'next', '-n', '--next')
+    PAGE_SIZE = int(os.getenv('SHOW_PAGE_SIZE', 30))
+    GUESS_LIMIT = 10
+    RESULTS = LRUCache('retrieve', int(os.getenv('RESULT_CACHE_SIZE', 1024)),
+                       float(os.getenv('RESULT_CACHE_TTL', 60)))
+    CANDIDATES = LRUCache('guess', int(os.getenv('RESULT_CACHE_SIZE', 1024)),
+                          float(os.getenv('RESULT_CACHE_TTL', 60)))
 
     def format_products(self, rows):
         """商品情報群を受け取り、文字列として整形して返します。
@@ -387,141 +650,253 @@ class ProductResponder(Responder):
             text += f'{shop}({branch}): [{amount}] {price}円\n'
         return text
 
-    def guess_product(self, text):
-        """文字列を受け取り、その文字列がなるべく長く一致する商品を探し、一覧を返します。
-        候補が1件しか見つからなかった場合にはその商品の情報を表示します。
+    def guess_product(self, session, text):
+        """文字列を受け取り、その文字列に似た商品を探し、一覧を返します。
+        候補が1件しか見つからなかった場合や、表記揺れを除いて商品名と一致した場合にはその商品の情報を表示します。
 
-        また、見つかった候補をguess[番号]=名前として登録していきます。
+        また、見つかった候補を番号で選べるようにguessに記録します。
         さらに、候補が見つかった場合はstateを'guess'に変更します。
 
         Args:
+            session (ResponderState): 会話状態。
             text (str): 商品名の一部。
 
         Returns:
             str or None: 候補が見つかれば、その一覧または情報。なければNone。
         """
-        base_sql = "select name from products where name ~* '{}'"
-        for word in generate_words(text):
-            sql = base_sql.format(word)
-            self.cursor.execute(sql)
-            rows = self.cursor.fetchall()
-            if rows:
-                res = f'目当ての商品があれば対応する番号を入力してください。\n無ければそれ以外の文字を送信してください。\n'
-                for n, name in enumerate(set(str(x[0]) for x in rows)):
-                    self.guess[n] = name
-                    res += f'{n}: {name}\n'
-                if len(self.guess) == 1:
-                    name = self.guess[0]
-                    return f"{name}の結果を表示しています。\n{self.retrieve(name)}"
-                self.state = 'guess'
-                return res
+        matches = self.find_candidates(text)
+        if not matches:
+            return None
+        session.guess = None
+        name, score = matches[0]
+        if len(matches) == 1 or (score == 1 and matches[1][1] < 1):
+            return f"{name}の結果を表示しています。\n{self.retrieve(session, name)}"
+        res = f'目当ての商品があれば対応する番号を入力してください。\n無ければそれ以外の文字を送信してください。\n'
+        for n, (name, _) in enumerate(matches):
+            res += f'{n}: {name}\n'
+        session.guess = tuple(name for name, _ in matches)
+        session.offset = 0
+        session.state = 'guess'
+        return res
 
-    def response(self, text):
+    def find_candidates(self, text):
+        """文字列に似た商品名を探し、一致度の高い順に返します。
+        Catalogを使う場合は、カタカナとひらがな、全角と半角を区別しないn-gram索引から最大GUESS_LIMIT件を返します。
+        Catalogを使わない場合は、文字列の先頭部分が最も長く一致する商品名をPREFIX_SQLの一度の問い合わせで探します。
+
+        Args:
+            text (str): 商品名の一部。
+
+        Returns:
+            tuple[tuple[str, float]]: 商品名と一致度(0から1)の組。
+        """
+        key = normalize(text) if Catalog.ENABLED else text.lower()
+        matches = self.CANDIDATES.get(key)
+        if matches is not None:
+            return matches
+        if Catalog.ENABLED:
+            matches = tuple(Catalog.search(text, self.GUESS_LIMIT))
+        else:
+            rows = self.fetch(self.PREFIX_SQL, {'text': text})
+            longest = rows[0][1] if rows else 0
+            matches = tuple((str(name), length / len(text))
+                            for name, length in rows if length == longest)
+        self.CANDIDATES.put(key, matches)
+        return matches
+
+    @classmethod
+    def invalidate(cls, names=None):
+        """商品情報が変わった商品名のキャッシュを破棄します。
+        候補は商品名が増えると変わるため、全て破棄します。
+
+        Args:
+            names (set[str], optional): 商品情報が変わった商品名。 省略すると全て破棄します。
+        """
+        if names is None:
+            cls.RESULTS.clear()
+        else:
+            for name in names:
+                cls.RESULTS.discard(name)
+        cls.CANDIDATES.clear()
+
+    def response(self, session, text):
         """文字列を受け取り、商品情報を単価の安い順, 数量の少ない順でソートして返します。
-        AddResponderを保持している場合はAddResponderとして振舞います。
+        AddResponderの会話状態を保持している場合はAddResponderとして振舞います。
 
         Args:
+            session (ResponderState): 会話状態。
             text (str): 検索したい文字列。
 
         Returns:
             str: 検索結果。または、AddReponderとしての応答。
         """
-        if self.adder is not None:
-            res = self.adder.response(text)
-            if self.adder.state == 'end':
-                self.adder.exit()
-                self.adder = None
-                self.end()
+        if session.adder is not None:
+            res = session.adder.response(text)
+            if session.adder.state == 'end':
+                session.adder.exit()
+                session.adder = None
+                session.end()
             return res
-        if self.state == 'guess':
-            res = self.truth_product(text)
-            self.end()
+        if session.page is not None and text.lower() in self.NEXT_WORDS:
+            ask = session.page['ask']
+            res = self.show_products(session, **session.page)
+            if session.page is None and not ask:
+                session.end()
+        elif session.state == 'guess':
+            res = self.truth_product(session, text)
+            session.end()
         elif text in ('-s', '--show'):
-            res = self.show_products()
-            self.end()
+            res = self.show_products(session)
+            if session.page is None:
+                session.end()
         elif text in ('-S', '--SHOW'):
-            res = self.show_products(True)
+            res = self.show_products(session, True)
         else:
-            res = self.retrieve(text)
-            if self.state != 'guess':
-                self.end()
+            session.page = None
+            res = self.retrieve(session, text)
+            if session.state != 'guess':
+                session.end()
         if not res:
             res = f"{text}が見つかりませんでした。\n登録されていないか、誤字脱字の可能性があります。"
         return res.strip()
 
-    def retrieve(self, text):
-        """データベースから商品情報を受け取り、整形して返します。
+    def retrieve(self, session, text):
+        """データベース、またはCatalogから商品情報を受け取り、整形して返します。
+        整形した結果はRESULTSに保持し、同じ商品名の参照ではデータベースを参照しません。
 
         Args:
+            session (ResponderState): 会話状態。
             text (str): 商品名。
 
         Returns:
             str: 商品情報。
         """
-        sql = f"select * from products where name='{text}' order by price/amount,amount limit 5"
-        self.cursor.execute(sql)
-        rows = self.cursor.fetchall()
-        if not rows:
-            return self.guess_product(text)
-        return self.format_products(rows)
+        res = self.RESULTS.get(text)
+        if res is None:
+            if Catalog.ENABLED:
+                rows = Catalog.retrieve(text)
+            else:
+                rows = self.fetch(self.RETRIEVE_SQL, {'name': text})
+            res = self.format_products(rows) if rows else ''
+            self.RESULTS.put(text, res)
+        if not res:
+            return self.guess_product(session, text)
+        return res
 
-    def show_products(self, ask=False):
-        """データベースに登録されている商品名の一覧を返します。
+    def list_products(self, after=None):
+        """商品名の一覧のうち、afterより後の1ページ分を返します。
+        データベースを参照する場合も、取得するのは1ページ分だけです。
+
+        Args:
+            after (str, optional): 前のページの最後の商品名。 省略すると最初のページです。
+
+        Returns:
+            tuple[list[str], bool]: 商品名の一覧と、次のページがあるかどうか。
+        """
+        limit = self.PAGE_SIZE + 1
+        if Catalog.ENABLED:
+            products = list(Catalog.page(after, limit))
+        else:
+            sql = self.LIST_SQL if after is None else self.LIST_AFTER_SQL
+            products = [
+                str(x[0]) for x in self.fetch(sql, {
+                    'after': after,
+                    'limit': limit
+                })
+            ]
+        return products[:self.PAGE_SIZE], len(products) == limit
+
+    def show_products(self, session, ask=False, after=None, offset=0):
+        """データベースに登録されている商品名の一覧を1ページ分返します。
         askを真にすると、商品一覧に番号が与えられ、guessステートになり、次に受け取る文字列がtruth_productされます。
+        guessに記録するのは表示したページの商品名だけです。
+
+        次のページがある場合はpageに続きの位置を記録し、NEXT_WORDSを受け取ると次のページを表示します。
+        askが偽の場合はpageステートになります。
 
         Args:
+            session (ResponderState): 会話状態。
             ask (bool, optional): 一覧を表示した後、問い合わせモードに移行するか。
+            after (str, optional): 前のページの最後の商品名。 省略すると最初のページです。
+            offset (int, optional): このページの最初の商品番号。
 
         Returns:
             str: 商品一覧。
         """
-        sql = 'select name from products order by name collate "ja_JP.utf8", shop_branch collate "ja_JP.utf8"'
-        self.cursor.execute(sql)
-        tmp = [str(x[0]) for x in self.cursor.fetchall()]
-        products = sorted(set(tmp), key=tmp.index)
+        products, more = self.list_products(after)
+        if more:
+            session.page = {
+                'ask': ask,
+                'after': products[-1],
+                'offset': offset + len(products)
+            }
+        else:
+            session.page = None
         if ask:
             res = ""
-            for i, product in enumerate(products):
+            for i, product in enumerate(products, offset):
                 res += f"{i}: {product}\n"
-                self.guess[i] = product
+            session.guess = tuple(products)
+            session.offset = offset
+            if more:
+                res += "\n続きを表示するには「次」を入力してください。"
             res += "\n目当ての商品番号を入力してください。\nそれ以外の文字を入力すると商品参照モードを終了します。"
-            self.state = 'guess'
+            session.state = 'guess'
             return res
-        else:
-            return "\n".join(products)
+        res = "\n".join(products)
+        if more:
+            res += "\n\n続きを表示するには「次」を入力してください。"
+            session.state = 'page'
+        return res
 
-    def truth_product(self, text):
-        """数値変換可能な文字列を受け取り、その値がguessに存在した場合、retrieve(guess[int(text)])を返します。
+    def truth_product(self, session, text):
+        """数値変換可能な文字列を受け取り、その番号の商品名がguessに存在した場合、その商品情報を返します。
 
         Args:
+            session (ResponderState): 会話状態。
             text (str): 数値変換可能な文字列。
 
         Returns:
             str: 商品情報の文字列。または、終了を伝えるメッセージ。
         """
         num = text_to_value(text, int)
-        if num in self.guess:
-            return self.retrieve(self.guess[num])
+        guess = session.guess or ()
+        if num is not None and 0 <= num - session.offset < len(guess):
+            return self.retrieve(session, guess[num - session.offset])
         return "問い合わせを終了しました。"
 
-    @property
-    def adder(self):
-        """商品情報を登録するレスポンダです。
-
-        Returns:
-            AddResponder or None: 商品情報を登録するレスポンダです。必要ないときはNoneです。
-        """
-        return self.__adder
-
-    @property
-    def guess(self):
-        """商品情報が見つからなかった時の予測候補です。
-
-        Returns:
-            dict: 商品情報の予測候補。
-        """
-        return self.__guess
 
+for engine in (AddResponder(), BatchAddResponder(), ProductResponder()):
+    Responder.engines[engine.NAME] = engine
+Database.prepare('upsert_product',
+                 AddResponder.UPSERT_SQL,
+                 name='text',
+                 amount='numeric',
+                 price='int',
+                 shop='text',
+                 shop_branch='text',
+                 check='boolean',
+                 retention='int')
+Database.prepare('batch_distinction',
+                 BatchAddResponder.DISTINCTION_SQL,
+                 names='text[]')
+Database.prepare('batch_upsert',
+                 BatchAddResponder.BATCH_UPSERT_SQL,
+                 names='text[]',
+                 amounts='numeric[]',
+                 prices='int[]',
+                 shops='text[]',
+                 shop_branches='text[]')
+Database.prepare('prefix_products', ProductResponder.PREFIX_SQL, text='text')
+Database.prepare('retrieve_product',
+                 ProductResponder.RETRIEVE_SQL,
+                 name='text')
+Database.prepare('list_products', ProductResponder.LIST_SQL, limit='int')
+Database.prepare('list_products_after',
+                 ProductResponder.LIST_AFTER_SQL,
+                 after='text',
+                 limit='int')
+Catalog.subscribe(ProductResponder.invalidate)
 
 if __name__ == '__main__':
     print("This module is not script file.")
@@ -0,0 +1,155 @@
+import threading
+
+from inner.database import Database
+
+
+class Schema:
+    """データベースのテーブルや索引を版数付きで管理するためのクラスです。
+
+    MIGRATIONSに(版数, 説明, sql群)を追加していくことでテーブルや索引を変更します。
+    適用済みの版数はschema_migrationsテーブルに記録され、未適用の版だけが版数の小さい順に適用されます。
+    複数のプロセスが同時に起動しても、適用はアドバイザリロックで一つずつ行われます。
+
+    一度公開した版は変更せず、変更が必要な場合は新しい版を追加してください。
+    起動時に適用される他、python -m inner.schemaで適用することもできます。
+    このクラスはインスタンスを必要としません。
+    """
+    LOCK_ID = 4242001
+    MIGRATIONS = (
+        (1, 'catalog version counter', (
+            'create table if not exists catalog_version '
+            '(id int primary key, version bigint not null)',
+            'insert into catalog_version values (1, 0) on conflict do nothing',
+        )),
+        (2, 'trigram index for product name search', (
+            'create extension if not exists pg_trgm',
+            'create index if not exists products_name_trgm '
+            'on products using gin (name gin_trgm_ops)',
+        )),
+        (3, 'stored unit price and index for cheapest lookups', (
+            'alter table products add column if not exists unit_price numeric '
+            'generated always as '
+            '(price::numeric / nullif(amount::numeric, 0)) stored',
+            'create index if not exists products_name_unit_price '
+            'on products (name, unit_price, amount) '
+            'include (price, shop, shop_branch)',
+            'analyze products',
+        )),
+        (4, 'exact amount and unique product key', (
+            'drop index if exists products_name_unit_price',
+            'alter table products drop column if exists unit_price',
+            'alter table products '
+            'alter column amount type numeric using amount::numeric',
+            'delete from products as a using products as b '
+            'where a.name = b.name and a.amount = b.amount '
+            'and a.shop = b.shop and a.shop_branch = b.shop_branch '
+            'and a.ctid < b.ctid',
+            'alter table products add constraint products_item_key '
+            'unique (name, amount, shop, shop_branch)',
+            'alter table products add column unit_price numeric '
+            'generated always as (price::numeric / nullif(amount, 0)) stored',
+            'create index products_name_unit_price '
+            'on products (name, unit_price, amount) '
+            'include (price, shop, shop_branch)',
+            'analyze products',
+        )),
+        (5, 'collated name index for paginated listing', ("""
+            create index if not exists products_name_ja
+            on products (name collate "ja_JP.utf8")
+            """, )),
+        (6, 'changed product names per catalog version', ("""
+            create table if not exists catalog_changes (
+                version bigint not null, name text not null,
+                primary key (version, name)
+            )
+            """, )),
+        (7, 'cheapest entries per product name', (
+            """
+            create table if not exists product_summaries (
+                name text primary key, amounts numeric[] not null,
+                prices int[] not null, shops text[] not null,
+                shop_branches text[] not null
+            )
+            """,
+            """
+            insert into product_summaries
+            select name, array_agg(amount order by n),
+                array_agg(price order by n), array_agg(shop order by n),
+                array_agg(shop_branch order by n)
+            from (
+                select name, amount, price, shop, shop_branch,
+                    row_number() over (
+                        partition by name order by unit_price, amount
+                    ) as n
+                from products
+            ) as ranked
+            where n <= 5
+            group by name
+            on conflict do nothing
+            """,
+        )),
+        (8, 'received webhook events shared by all workers', (
+            'create table if not exists webhook_events '
+            '(event_id text primary key, received timestamptz not null)',
+            'create index if not exists webhook_events_received '
+            'on webhook_events (received)',
+        )),
+    )
+    __ready = False
+    __lock = threading.Lock()
+
+    @classmethod
+    def applied(cls, cursor):
+        """適用済みの版数を返します。
+
+        Args:
+            cursor (connect.cursor): カーソル。
+
+        Returns:
+            set[int]: 適用済みの版数。
+        """
+        cursor.execute('create table if not exists schema_migrations '
+                       '(version int primary key, description text not null, '
+                       'applied_at timestamptz not null default now())')
+        cursor.execute('select version from schema_migrations')
+        return {x[0] for x in cursor.fetchall()}
+
+    @classmethod
+    def migrate(cls):
+        """未適用の版を一つのトランザクションで適用します。
+
+        Returns:
+            list[int]: 今回適用した版数。
+        """
+        done = []
+        with Database.cursor(True) as cursor:
+            cursor.execute('select pg_advisory_xact_lock(%s)', (cls.LOCK_ID, ))
+            applied = cls.applied(cursor)
+            for version, description, statements in cls.MIGRATIONS:
+                if version in applied:
+                    continue
+                for sql in statements:
+                    cursor.execute(sql)
+                cursor.execute(
+                    'insert into schema_migrations (version, description) '
+                    'values (%s, %s)', (version, description))
+                done.append(version)
+        return done
+
+    @classmethod
+    def setup(cls):
+        """未適用の版を適用します。
+        プロセス毎に一度だけ実行されます。
+        """
+        if cls.__ready:
+            return
+        with cls.__lock:
+            if cls.__ready:
+                return
+            for version in cls.migrate():
+                print(f"schema migrated: {version}")
+            cls.__ready = True
+
+
+if __name__ == '__main__':
+    Schema.setup()
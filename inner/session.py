@@ -0,0 +1,549 @@
+import heapq
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class SessionStore:
+    """ユーザー毎の会話状態を有効期限付きで保持する辞書の基底クラスです。
+
+    会話状態は{'responder': ResponderState, 'status': str,
+    'timeout': datetime}の辞書です。
+    取り出した会話状態を変更した場合は、saveで保存し直してください。
+    有効期限は会話状態のtimeoutで、ユーザー毎に異なる値を設定できます。
+
+    以下の環境変数で使用する実装を選べます。
+        SESSION_STORE: memoryならMemorySessions、sqliteならSQLiteSessionsを使います。
+            標準はmemoryです。
+        SESSION_DB: SQLiteSessionsが使うファイルのパス。 標準はsessions.sqlite3です。
+
+    Attributes:
+        on_expire (func): 期限切れで削除したユーザーのIDと会話状態を受け取る関数です。
+        SHARED (bool): 会話状態を複数のプロセスで共有するかどうかです。 共有する場合、lenは全てのプロセスの合計です。
+    """
+    SHARED = False
+
+    def __init__(self, on_expire=None):
+        """初期化します。
+
+        Args:
+            on_expire (func, optional): 期限切れで削除したユーザーのIDと会話状態を受け取る関数。
+        """
+        self.on_expire = on_expire
+
+    @staticmethod
+    def create(on_expire=None):
+        """環境変数SESSION_STOREに応じた実装を生成します。
+
+        Args:
+            on_expire (func, optional): 期限切れで削除したユーザーのIDと会話状態を受け取る関数。
+
+        Returns:
+            SessionStore: 会話状態を保持する辞書。
+        """
+        store = os.getenv('SESSION_STORE', 'memory')
+        if store == 'sqlite':
+            return SQLiteSessions(os.getenv('SESSION_DB', 'sessions.sqlite3'),
+                                  on_expire)
+        if store != 'memory':
+            print(f"SESSION_STORE={store}は使用できません。memoryを使用します。")
+        return MemorySessions(on_expire)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        session = self.get(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        return session
+
+    def notify(self, expired):
+        """期限切れで削除したユーザーをon_expireに通知します。
+
+        Args:
+            expired (list[tuple[str, dict]]): 削除したユーザーのIDと会話状態。
+        """
+        if self.on_expire is None:
+            return
+        for user_id, session in expired:
+            self.on_expire(user_id, session)
+
+    def expire(self):
+        """有効期限が過ぎたユーザーを全て削除します。
+        子クラスにて独自定義してください。
+
+        Returns:
+            list[str]: 削除したユーザーID。
+        """
+        raise NotImplementedError
+
+    def get(self, user_id, default=None):
+        """ユーザーの会話状態を返します。
+        有効期限が過ぎていた場合は削除し、defaultを返します。
+        子クラスにて独自定義してください。
+
+        Args:
+            user_id (str): ユーザーID。
+            default (any, optional): 会話状態が無い場合に返す値。
+
+        Returns:
+            dict or any: 会話状態。
+        """
+        raise NotImplementedError
+
+    def pop(self, user_id, default=None):
+        """ユーザーの会話状態を削除して返します。
+        子クラスにて独自定義してください。
+
+        Args:
+            user_id (str): ユーザーID。
+            default (any, optional): 会話状態が無い場合に返す値。
+
+        Returns:
+            dict or any: 削除した会話状態。
+        """
+        raise NotImplementedError
+
+    def save(self, user_id, session):
+        """ユーザーの会話状態を保存し、timeoutを有効期限に設定します。
+        子クラスにて独自定義してください。
+
+        Args:
+            user_id (str): ユーザーID。
+            session (dict): 会話状態。
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, user_id):
+        """ユーザーの会話状態の読み込みから保存までを、会話状態を共有する全てのプロセスの間で一つずつ順に行います。
+        withを抜けると解放します。
+        プロセス内での順序はSessionLocksが守るため、プロセス間で共有しない実装では何もしません。
+
+            with users.lock(user_id):
+                session = users.get(user_id)
+                ...
+                users.save(user_id, session)
+
+        Args:
+            user_id (str): ユーザーID。
+        """
+        yield
+
+    def setdefault(self, user_id, default):
+        """ユーザーの会話状態を返します。
+        会話状態が無い、あるいは有効期限が過ぎていた場合はdefaultを返します。
+        子クラスにて独自定義してください。
+
+        Args:
+            user_id (str): ユーザーID。
+            default (dict): 新しい会話状態。
+
+        Returns:
+            dict: 会話状態。
+        """
+        raise NotImplementedError
+
+
+class SessionShard:
+    """MemorySessionsの区画です。 区画毎のロックで、区画に属するユーザーの会話状態と有効期限を守ります。
+
+    Attributes:
+        lock (threading.Lock): 区画のロック。
+        items (dict): ユーザーIDと会話状態の辞書。
+        expires (dict): ユーザーIDと有効期限の辞書。
+        heap (list[tuple[datetime, str]]): 有効期限とユーザーIDの優先度付きキュー。
+    """
+    __slots__ = ('lock', 'items', 'expires', 'heap')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+        self.expires = {}
+        self.heap = []
+
+    def pop_expired(self, user_id, now):
+        """ユーザーの有効期限が過ぎていれば削除して返します。 lockを取得してから呼び出してください。
+
+        Args:
+            user_id (str): ユーザーID。
+            now (datetime): 現在時刻。
+
+        Returns:
+            tuple[str, dict] or None: 削除したユーザーIDと会話状態。
+        """
+        expires = self.expires.get(user_id)
+        if expires is None or expires > now:
+            return None
+        del self.expires[user_id]
+        return (user_id, self.items.pop(user_id))
+
+
+class MemorySessions(SessionStore):
+    """会話状態をプロセス内に保持する辞書です。
+
+    ユーザーIDのハッシュ値でSHARDS個の区画に分け、区画毎のロックで守るため、
+    異なる区画のユーザーは複数のスレッドから並行して読み書きできます。
+    有効期限は区画毎の優先度付きキューで管理し、期限を迎えたユーザーだけを取り出して削除します。
+    削除は期限を待つスレッドが行う他、期限切れのユーザーを参照した時点でも行います。
+
+    以下の環境変数で設定を変更できます。
+        SESSION_SHARDS: 区画の数。 標準は16です。
+    """
+    SHARDS = max(1, int(os.getenv('SESSION_SHARDS', 16)))
+
+    def __init__(self, on_expire=None):
+        """空の区画を用意し、期限を待つスレッドを開始します。
+
+        Args:
+            on_expire (func, optional): 期限切れで削除したユーザーのIDと会話状態を受け取る関数。
+        """
+        super().__init__(on_expire)
+        self.__shards = tuple(SessionShard() for _ in range(self.SHARDS))
+        self.__next = None
+        self.__condition = threading.Condition()
+        self.__th = threading.Thread(target=self.__watch)
+        self.__th.daemon = True
+        self.__th.start()
+
+    def __iter__(self):
+        users = []
+        for shard in self.__shards:
+            with shard.lock:
+                users.extend(shard.items)
+        return iter(users)
+
+    def __len__(self):
+        return sum(len(x.items) for x in self.__shards)
+
+    def __shard(self, user_id):
+        """ユーザーが属する区画を返します。
+
+        Args:
+            user_id (str): ユーザーID。
+
+        Returns:
+            SessionShard: 区画。
+        """
+        return self.__shards[hash(user_id) % len(self.__shards)]
+
+    def __earliest(self):
+        """全ての区画で最も近い有効期限を返します。
+
+        Returns:
+            datetime or None: 有効期限。 誰も登録されていない場合はNoneです。
+        """
+        earliest = None
+        for shard in self.__shards:
+            with shard.lock:
+                if not shard.heap:
+                    continue
+                if earliest is None or shard.heap[0][0] < earliest:
+                    earliest = shard.heap[0][0]
+        return earliest
+
+    def __watch(self):
+        """最も近い有効期限まで待機し、期限を迎えたユーザーを削除し続けます。
+        """
+        while True:
+            with self.__condition:
+                self.__next = self.__earliest()
+                if self.__next is None:
+                    self.__condition.wait()
+                else:
+                    wait = (self.__next - datetime.now()).total_seconds()
+                    if wait > 0:
+                        self.__condition.wait(wait)
+            self.expire()
+
+    def expire(self):
+        """有効期限が過ぎたユーザーを全て削除します。
+        確認するのは各区画で期限を迎えたキューの先頭だけです。
+
+        Returns:
+            list[str]: 削除したユーザーID。
+        """
+        now = datetime.now()
+        expired = []
+        for shard in self.__shards:
+            with shard.lock:
+                heap = shard.heap
+                while heap and heap[0][0] <= now:
+                    expires, user_id = heapq.heappop(heap)
+                    if shard.expires.get(user_id) != expires:
+                        continue
+                    del shard.expires[user_id]
+                    expired.append((user_id, shard.items.pop(user_id)))
+        self.notify(expired)
+        return [user_id for user_id, _ in expired]
+
+    def get(self, user_id, default=None):
+        shard = self.__shard(user_id)
+        with shard.lock:
+            expired = shard.pop_expired(user_id, datetime.now())
+            session = shard.items.get(user_id, default)
+        if expired is not None:
+            self.notify([expired])
+        return session
+
+    def pop(self, user_id, default=None):
+        shard = self.__shard(user_id)
+        with shard.lock:
+            shard.expires.pop(user_id, None)
+            return shard.items.pop(user_id, default)
+
+    def save(self, user_id, session):
+        expires = session['timeout']
+        shard = self.__shard(user_id)
+        with shard.lock:
+            shard.items[user_id] = session
+            if expires is None or shard.expires.get(user_id) == expires:
+                return
+            shard.expires[user_id] = expires
+            heapq.heappush(shard.heap, (expires, user_id))
+        with self.__condition:
+            if self.__next is None or expires < self.__next:
+                self.__next = expires
+                self.__condition.notify()
+
+    def setdefault(self, user_id, default):
+        shard = self.__shard(user_id)
+        with shard.lock:
+            expired = shard.pop_expired(user_id, datetime.now())
+            session = shard.items.setdefault(user_id, default)
+        if expired is not None:
+            self.notify([expired])
+        return session
+
+
+class SessionLocks:
+    """ユーザー毎のロックです。 同じユーザーの処理を一つずつ順に行うために使います。
+
+    ロックは使用中のユーザーの分だけ保持し、使い終えたものは破棄します。
+    ロックの表もユーザーIDのハッシュ値で区画に分けているため、異なるユーザーが互いを待つことはありません。
+
+    Examples:
+        >>> locks = SessionLocks()
+        >>> with locks('user'):
+        ...     len(locks)
+        1
+        >>> len(locks)
+        0
+    """
+    def __init__(self, shards=MemorySessions.SHARDS):
+        """初期化します。
+
+        Args:
+            shards (int, optional): ロックの表の区画の数。
+        """
+        self.__shards = tuple(
+            (threading.Lock(), {}) for _ in range(max(1, shards)))
+
+    def __len__(self):
+        return sum(len(x[1]) for x in self.__shards)
+
+    @contextmanager
+    def __call__(self, user_id):
+        """ユーザーのロックを取得します。 withを抜けると解放します。
+
+        Args:
+            user_id (str): ユーザーID。
+        """
+        guard, locks = self.__shards[hash(user_id) % len(self.__shards)]
+        with guard:
+            entry = locks.get(user_id)
+            if entry is None:
+                entry = locks[user_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del locks[user_id]
+
+
+class SQLiteSessions(SessionStore):
+    """会話状態をSQLiteのファイルに保持する辞書です。
+
+    WALモードで開くため、同じファイルを複数のプロセスから読み書きでき、
+    どのプロセスでもユーザーの会話を続けられます。
+    会話状態はpickleで保存します。 ResponderStateは小さな値だけを持つため、そのまま保存できます。
+
+    有効期限には索引を張っているため、削除の手間は期限を迎えたユーザーの数にだけ比例します。
+    削除はSWEEP_INTERVAL秒毎に行う他、期限切れのユーザーを参照した時点でも行います。
+
+    同じユーザーのメッセージを別々のプロセスが同時に処理すると、後に保存した側が先の変更を上書きしてしまいます。
+    これを防ぐため、lockはsession_locksテーブルにユーザー毎の貸出期限付きの行を置き、プロセスをまたいで処理を一つずつにします。
+    行を置けなかったプロセスは、先の処理が行を消すか、貸出期限のLOCK_TTL秒が過ぎるまで待ちます。
+    貸出期限があるため、処理の途中で止まったプロセスの行も残り続けません。
+
+    以下の環境変数で設定を変更できます。
+        SESSION_SWEEP: 期限切れのユーザーを削除する間隔の秒数。 標準は30秒です。
+        SESSION_LOCK_TTL: lockの貸出期限の秒数。 1回の応答にかかる時間より十分長くしてください。 標準は30秒です。
+    """
+    SHARED = True
+    SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP', 30))
+    LOCK_TTL = float(os.getenv('SESSION_LOCK_TTL', 30))
+    LOCK_POLL = (0.005, 0.05)
+
+    def __init__(self, path, on_expire=None):
+        """テーブルを用意し、期限切れのユーザーを削除するスレッドを開始します。
+
+        Args:
+            path (str or Path): SQLiteのファイルのパス。
+            on_expire (func, optional): 期限切れで削除したユーザーのIDと会話状態を受け取る関数。
+        """
+        super().__init__(on_expire)
+        self.__path = str(path)
+        self.__local = threading.local()
+        connection = self.__connection()
+        connection.execute(
+            'create table if not exists sessions (user_id text primary key, '
+            'expires real not null, data blob not null)')
+        connection.execute(
+            'create index if not exists sessions_expires on sessions (expires)'
+        )
+        connection.execute('create table if not exists session_locks '
+                           '(user_id text primary key, owner text not null, '
+                           'expires real not null)')
+        self.__th = threading.Thread(target=self.__watch)
+        self.__th.daemon = True
+        self.__th.start()
+
+    def __iter__(self):
+        rows = self.__connection().execute('select user_id from sessions')
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.__connection().execute(
+            'select count(*) from sessions').fetchone()[0]
+
+    def __connection(self):
+        """スレッド毎のSQLiteとの接続を返します。
+
+        Returns:
+            sqlite3.Connection: SQLiteとの接続。
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path,
+                                         timeout=10,
+                                         isolation_level=None)
+            connection.execute('pragma journal_mode=wal')
+            connection.execute('pragma synchronous=normal')
+            self.__local.connection = connection
+        return connection
+
+    def __watch(self):
+        """SWEEP_INTERVAL秒毎に期限切れのユーザーを削除し続けます。
+        """
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            try:
+                self.expire()
+            except sqlite3.Error as e:
+                print(f"session sweep failed: {e}")
+
+    def expire(self):
+        now = datetime.now().timestamp()
+        connection = self.__connection()
+        connection.execute('begin immediate')
+        try:
+            rows = connection.execute(
+                'select user_id, data from sessions where expires <= ?',
+                (now, )).fetchall()
+            connection.execute('delete from sessions where expires <= ?',
+                               (now, ))
+            connection.execute('commit')
+        except Exception:
+            connection.execute('rollback')
+            raise
+        self.notify([(user_id, pickle.loads(data)) for user_id, data in rows])
+        return [user_id for user_id, _ in rows]
+
+    def get(self, user_id, default=None):
+        connection = self.__connection()
+        row = connection.execute(
+            'select expires, data from sessions where user_id = ?',
+            (user_id, )).fetchone()
+        if row is None:
+            return default
+        expires, data = row
+        session = pickle.loads(data)
+        if expires > datetime.now().timestamp():
+            return session
+        deleted = connection.execute(
+            'delete from sessions where user_id = ? and expires = ?',
+            (user_id, expires)).rowcount
+        if deleted:
+            self.notify([(user_id, session)])
+        return default
+
+    def pop(self, user_id, default=None):
+        connection = self.__connection()
+        connection.execute('begin immediate')
+        try:
+            row = connection.execute(
+                'select data from sessions where user_id = ?',
+                (user_id, )).fetchone()
+            connection.execute('delete from sessions where user_id = ?',
+                               (user_id, ))
+            connection.execute('commit')
+        except Exception:
+            connection.execute('rollback')
+            raise
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    def save(self, user_id, session):
+        expires = session['timeout'].timestamp()
+        data = pickle.dumps(session, pickle.HIGHEST_PROTOCOL)
+        self.__connection().execute(
+            'insert or replace into sessions values (?, ?, ?)',
+            (user_id, expires, data))
+
+    def setdefault(self, user_id, default):
+        return self.get(user_id, default)
+
+    @contextmanager
+    def lock(self, user_id):
+        connection = self.__connection()
+        owner = uuid.uuid4().hex
+        delay = self.LOCK_POLL[0]
+        while True:
+            now = time.time()
+            expires = now + self.LOCK_TTL
+            # upsert(on conflict)はSQLite 3.24以降でしか使えないため、挿入と期限切れの行の引き継ぎに分けます。
+            cursor = connection.execute(
+                'insert or ignore into session_locks values (?, ?, ?)',
+                (user_id, owner, expires))
+            if cursor.rowcount:
+                break
+            cursor = connection.execute(
+                'update session_locks set owner = ?, expires = ? '
+                'where user_id = ? and (owner = ? or expires <= ?)',
+                (owner, expires, user_id, owner, now))
+            if cursor.rowcount:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, self.LOCK_POLL[1])
+        try:
+            yield
+        finally:
+            connection.execute(
+                'delete from session_locks where user_id = ? and owner = ?',
+                (user_id, owner))
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
@@ -1,10 +1,14 @@
-import re
-import threading
-import time
 from datetime import datetime, timedelta
 
+from inner.admission import Admission
 from inner.loader import Loader
-from inner.responder import AddResponder, ProductResponder
+from inner.matcher import ActionMatcher
+from inner.metrics import Metrics
+from inner.responder import AddResponder, BatchAddResponder, ProductResponder
+from inner.session import SessionLocks, SessionStore
+
+EXPIRED_SESSIONS = Metrics.counter('linebot_sessions_expired_total',
+                                   'Sessions removed by timeout.')
 
 
 class Talker:
@@ -12,36 +16,31 @@ class Talker:
     特定のパターンに一致する場合には商品をデータベースに登録する動作を行します。
     一致しない場合は商品検索モードで動作します。
 
+    複数のスレッドから呼び出せます。 同じユーザーのdialogueはユーザー毎のロックで一つずつ順に処理し、
+    異なるユーザーのdialogueは並行して処理します。
 
     Attributes:
         users: 現在処理を行っている最中のユーザーの辞書です。
         actions: アクションを行う反応パターンです。
+        matcher: actionsを一つにまとめた照合器です。
     """
     def __init__(self):
         """文字列を受け取り、処理を返します。
 
         反応パターンを読み込みます。
         ユーザーの辞書を用意します。
-        定期的にタイムアウトしたユーザーを辞書から削除します。
+        タイムアウトしたユーザーは辞書から削除されます。
         """
         self.__actions = Loader.load_action()
-        self.__users = {}
-        self.__th = threading.Thread(
-            target=lambda: self.schedule(30, self.check_timeout, False))
-        self.__th.setDaemon(True)
-        self.__th.start()
+        self.__matcher = ActionMatcher(self.actions)
+        self.__users = SessionStore.create(self.expire_user)
+        self.__locks = SessionLocks()
 
     def check_timeout(self):
-        """usersに登録されているユーザーのtimeoutを確認し、過ぎていればそのユーザーの登録を解除します。
+        """usersに登録されているユーザーのうち、timeoutが過ぎているユーザーの登録を解除します。
+        通常はusersが自動で解除するため、呼び出す必要はありません。
         """
-        del_users = []
-        for user in self.users:
-            timeout = self.users[user]['timeout']
-            if timeout < datetime.now():
-                del_users.append(user)
-                print(f"delete: {user}")
-        for user in del_users:
-            self.delete_user(user)
+        self.users.expire()
 
     def delete_user(self, user_id):
         """ユーザーを削除します。
@@ -50,14 +49,15 @@ class Talker:
         Args:
             user_id (str): ユーザーID。
         """
-        if user_id in self.users:
-            responder = self.users[user_id]['responder']
-            if responder is not None:
-                responder.exit()
-            del self.users[user_id]
+        user = self.users.pop(user_id)
+        if user is not None and user['responder'] is not None:
+            user['responder'].exit()
 
     def dialogue(self, user_id, text):
         """ユーザーIDと文字列を受け取り、ユーザー毎に保持しているResponderからの応答を返します。
+        同じユーザーの呼び出しが重なった場合は、先の呼び出しが終わるまで待ちます。
+        会話状態を複数のプロセスで共有している場合は、他のプロセスの呼び出しが終わるまでも待ちます。
+        Admissionが処理を断った場合は、会話を進めずに定型文を返します。
 
         Args:
             user_id (str): ユーザーID。
@@ -66,39 +66,68 @@ class Talker:
         Returns:
             str: Responderからの応答。
         """
-        text = text.strip()
-        self.entry_user(user_id, text)
-        user = self.users[user_id]
-        if user['status'] == 'cancel':
-            res = "取り消しました" if user['responder'] is not None else None
-            self.delete_user(user_id)
+        with self.__locks(user_id), self.users.lock(user_id):
+            text = text.strip()
+            session = self.users.get(user_id)
+            reason = Admission.admit(user_id, self.classify(session, text))
+            if reason is not None:
+                return Admission.reply(reason)
+            user = self.entry_user(user_id, text)
+            if user['status'] == 'cancel':
+                res = "取り消しました" if user['responder'] is not None else None
+                self.delete_user(user_id)
+                return res
+            if user['status'] == 'help':
+                self.delete_user(user_id)
+                return self.show_help()
+            responder = user['responder']
+            with Admission.slot() as admitted:
+                if not admitted:
+                    return Admission.reply('busy')
+                res = responder.response(text)
+            if responder.state == 'end':
+                self.delete_user(user_id)
+            else:
+                self.users.save(user_id, user)
             return res
-        if user['status'] == 'help':
-            self.delete_user(user_id)
-            return self.show_help()
-        responder = user['responder']
-        res = responder.response(text)
-        if responder.state == 'end':
-            self.delete_user(user_id)
-        return res
+
+    def expire_user(self, user_id, user):
+        """タイムアウトで登録を解除されたユーザーの終了処理を行います。
+
+        Args:
+            user_id (str): ユーザーID。
+            user (dict): 解除されたユーザーの情報。
+        """
+        print(f"delete: {user_id}")
+        EXPIRED_SESSIONS.inc()
+        if user['responder'] is not None:
+            user['responder'].exit()
 
     def entry_user(self, user_id, text):
         """ユーザーを登録します。
         受け取ったuser_idをキーにします。
         受け取った文字列を基にResponder, status, timeoutを値にします。
+        timeoutが過ぎていたユーザーは新たに登録し直します。
 
         Args:
             user_id (str): ユーザーID.
             text (str): 文字列。
+
+        Returns:
+            dict: 登録したユーザーの情報。
         """
-        self.users.setdefault(user_id, {
+        user = self.users.setdefault(user_id, {
             'responder': None,
             'status': None,
             'timeout': None
         })
-        self.set_status(user_id, text)
-        self.set_responder(user_id, text)
-        self.set_timeout(user_id)
+        with Metrics.stage('classify'):
+            self.set_status(user, text)
+        with Metrics.stage('responder'):
+            self.set_responder(user, text)
+        self.set_timeout(user)
+        self.users.save(user_id, user)
+        return user
 
     def show_help(self):
         """このチャットボットで使用可能な機能の使い方を表示します。
@@ -108,8 +137,12 @@ class Talker:
         """
         helps = [
             '\n　'.join(('[ 商品を登録 ] ', '追加', 'ついか', '登録', 'とうろく', 'add')),
+            '\n　'.join(('[ 商品をまとめて登録 ]', '商品名, 分量, 価格, 店, 支店名の5行を繰り返す',
+                        'または5項目をタブで区切った行を並べる')),
             '\n　'.join(('[ 登録されている商品名一覧を表示 ]', '--show', '-s')),
             '\n　'.join(('[ 商品名一覧から番号を指定して参照 ]', '--SHOW', '-S')),
+            '\n　'.join(
+                ('[ 商品名一覧の次のページを表示 ]', '次', 'つぎ', 'next', '--next', '-n')),
             '\n　'.join(('[ 商品情報を確認 ]', '商品名')),
             '\n　'.join(
                 ('[ 進行中の処理を中断 ]', '取り消し', '取消', 'とりけし', 'キャンセル', 'cancel')),
@@ -118,82 +151,83 @@ class Talker:
         ]
         return "\n\n".join(helps)
 
-    def schedule(self, interval, f, wait=True):
-        """指定した関数を定期的に実行するスレッドを生成します。
-
-        Args:
-            interval (int): 実行間隔。
-            f (func): 実行する関数。
-            wait (bool, optional): 実行中に待機するかどうか。
+    def reload_actions(self):
+        """反応パターンが読み込み直されていれば、照合器を作り直します。
         """
-        base_time = time.time()
-        next_time = 0
-        while True:
-            t = threading.Thread(target=f)
-            t.start()
-            if wait:
-                t.join()
-            next_time = ((base_time - time.time()) % interval) or interval
-            time.sleep(next_time)
-
-    def set_responder(self, user_id, text: str):
-        """ユーザーのstatusに応じてResponderを生成し、保持します。
+        actions = Loader.load_action()
+        if actions is not self.actions:
+            self.__matcher = ActionMatcher(actions)
+            self.__actions = actions
+
+    def set_responder(self, user, text: str):
+        """ユーザーのstatusに応じてResponderの会話状態を生成し、保持します。
         superaddステータスの場合は特殊な処理を行います。
+        商品が1件であれば入力済みのAddResponderを、複数件あるいはタブ区切りであればBatchAddResponderを使います。
 
         Args:
-            user_id (str): ユーザID。
+            user (dict): ユーザーの情報。
             text (str): 文字列。
         """
-        user = self.users[user_id]
         if user['responder'] is not None:
             return
         status = user['status']
         if status == 'superadd':
-            tmp = map(lambda x: x.strip(), text.split('\n'))
-            try:
-                name, amount, price, shop, branch = [x for x in tmp if x]
-                responder = AddResponder(name=name,
-                                         amount=amount,
-                                         price=price,
-                                         shop=shop,
-                                         shop_branch=branch)
-            except Exception:
-                responder = AddResponder()
+            records = BatchAddResponder.split(text)
+            if len(records) > 1 or '\t' in text:
+                responder = BatchAddResponder.shared().start()
+            else:
+                try:
+                    name, amount, price, shop, branch = records[0]
+                    responder = AddResponder.shared().start(name=name,
+                                                            amount=amount,
+                                                            price=price,
+                                                            shop=shop,
+                                                            shop_branch=branch)
+                except Exception:
+                    responder = AddResponder.shared().start()
         elif status == 'add':
-            responder = AddResponder()
+            responder = AddResponder.shared().start()
         elif status == 'products':
-            responder = ProductResponder()
+            responder = ProductResponder.shared().start()
         elif status == 'show':
-            responder = ProductResponder()
+            responder = ProductResponder.shared().start()
         else:
             responder = None
         user['responder'] = responder
 
-    def set_status(self, user_id, text):
-        """ユーザーにstatusを設定します。
+    def classify(self, user, text):
+        """文字列から、ユーザーに設定するstatusを判定します。
+        反応パターンに一致しない場合は、ユーザーのstatusを引き継ぎます。
 
         Args:
-            user_id (str): ユーザーID。
+            user (dict or None): ユーザーの情報。 登録されていない場合はNoneです。
             text (str): 文字列。
+
+        Returns:
+            str: status。
         """
-        user = self.users[user_id]
-        text = text.lower()
-        for ptn in self.actions:
-            matcher = re.search(ptn['pattern'], text)
-            if matcher:
-                user['status'] = ptn['status']
-                break
-        else:
+        self.reload_actions()
+        status = self.matcher.classify(text.lower())
+        if status is None and user is not None:
             status = user['status']
-            if status is None:
-                status = 'products'
-            user['status'] = status
+        return status or 'products'
+
+    def set_status(self, user, text):
+        """ユーザーにstatusを設定します。
+
+        Args:
+            user (dict): ユーザーの情報。
+            text (str): 文字列。
+        """
+        user['status'] = self.classify(user, text)
 
-    def set_timeout(self, user_id, **timeout):
+    def set_timeout(self, user, **timeout):
         """ユーザーにタイムアウトを設定します。
 
+        timeoutにはtimedeltaと同じキーワード引数を指定でき、ユーザー毎に異なる値を設定できます。
+
         Args:
-            user_id (str): ユーザーID。
+            user (dict): ユーザーの情報。
         """
         options = ('days', 'seconds', 'microseconds', 'milliseconds',
                    'minutes', 'hours', 'weeks')
@@ -203,23 +237,32 @@ class Talker:
             timeout = None
         if not timeout:
             timeout = {'minutes': 3}
-        self.users[user_id]['timeout'] = datetime.now() + timedelta(**timeout)
+        user['timeout'] = datetime.now() + timedelta(**timeout)
 
     @property
     def actions(self):
         """反応する特別な文字列の辞書です。
 
         Returns:
-            dict: 反応する特別な文字列の辞書。
+            tuple[MappingProxyType]: 反応する特別な文字列の辞書。
         """
         return self.__actions
 
+    @property
+    def matcher(self):
+        """反応パターンを一度の照合で判定するための照合器です。
+
+        Returns:
+            ActionMatcher: 反応パターンの照合器。
+        """
+        return self.__matcher
+
     @property
     def users(self):
         """ユーザーを登録しておく辞書です。
 
         Returns:
-            dict: ユーザーを登録しておく辞書。
+            SessionStore: ユーザーを登録しておく辞書。
         """
         return self.__users
 
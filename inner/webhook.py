@@ -0,0 +1,104 @@
+import os
+import time
+
+import psycopg2
+
+from inner.cache import LRUCache
+from inner.database import Database
+from inner.metrics import Metrics
+
+DUPLICATES = Metrics.counter(
+    'linebot_webhook_duplicates_total',
+    'Redelivered webhook events that were not dispatched again.')
+
+
+class WebhookEvents:
+    """再送されたWebhookのイベントを二度処理しないためのクラスです。
+
+    受け付けたイベントのキーをデータベースのwebhook_eventsテーブルに記録します。
+    記録は全てのプロセスで共有するため、再送が別のワーカーに届いても処理しません。
+    同じイベントが同時に複数のワーカーに届いた場合も、記録できた一つだけが処理します。
+    処理に失敗した場合はreleaseで記録を取り消し、再送されたイベントを処理できるようにします。
+
+    記録したキーはプロセス内のLRUCache(LOCAL)にも保持し、同じワーカーへの再送はデータベースに問い合わせずに処理しません。
+    データベースに接続できない間はLOCALだけで判定するため、Catalogから商品情報を返す処理は止まりません。
+    その間は別のワーカーへの再送を検出できません。
+
+    このクラスはインスタンスを必要としません。
+
+    以下の環境変数で設定を変更できます。
+        WEBHOOK_DEDUP_TTL: 記録を有効とする秒数。 これより古い記録のイベントは処理し直します。 標準は600秒です。
+        WEBHOOK_DEDUP_SIZE: LOCALに保持するキーの数。 標準は10000件です。
+
+    Attributes:
+        CLAIM_SQL (str): イベントを記録するsqlです。 未記録か、記録が古い場合だけ1行を書き込みます。
+        RELEASE_SQL (str): イベントの記録を取り消すsqlです。
+        PRUNE_SQL (str): 古い記録を削除するsqlです。 PRUNE_INTERVAL秒毎に記録と合わせて発行します。
+        LOCAL (LRUCache): このプロセスで記録したキーのキャッシュです。
+    """
+    TTL = float(os.getenv('WEBHOOK_DEDUP_TTL', 600))
+    PRUNE_INTERVAL = 60
+    CLAIM_SQL = """
+        insert into webhook_events (event_id, received)
+        values (%(event_id)s, now())
+        on conflict (event_id) do update set received = excluded.received
+        where webhook_events.received < now() - %(ttl)s * interval '1 second'
+    """
+    RELEASE_SQL = 'delete from webhook_events where event_id = %(event_id)s'
+    PRUNE_SQL = """
+        delete from webhook_events
+        where received < now() - %(ttl)s * interval '1 second'
+    """
+    LOCAL = LRUCache('webhook', int(os.getenv('WEBHOOK_DEDUP_SIZE', 10000)),
+                     TTL)
+    __pruned = 0
+
+    @classmethod
+    def claim(cls, event_id):
+        """イベントを記録します。
+
+        Args:
+            event_id (str): イベントのキー。
+
+        Returns:
+            bool: 記録できたかどうか。 既に記録されていた(再送された)場合はFalseです。
+        """
+        if not cls.LOCAL.add(event_id):
+            DUPLICATES.inc()
+            return False
+        now = time.monotonic()
+        try:
+            with Database.cursor(True) as cursor:
+                if now - cls.__pruned >= cls.PRUNE_INTERVAL:
+                    cls.__pruned = now
+                    cursor.execute(cls.PRUNE_SQL, {'ttl': cls.TTL})
+                cursor.execute(cls.CLAIM_SQL, {
+                    'event_id': event_id,
+                    'ttl': cls.TTL
+                })
+                claimed = cursor.rowcount == 1
+        except psycopg2.Error as e:
+            print(f"webhook event {event_id} was recorded only "
+                  f"in this process: {e}")
+            return True
+        if not claimed:
+            DUPLICATES.inc()
+        return claimed
+
+    @classmethod
+    def release(cls, event_id):
+        """イベントの記録を取り消します。 処理に失敗したイベントを再送時に処理し直すために使います。
+
+        Args:
+            event_id (str): イベントのキー。
+        """
+        cls.LOCAL.discard(event_id)
+        try:
+            with Database.cursor(True) as cursor:
+                cursor.execute(cls.RELEASE_SQL, {'event_id': event_id})
+        except psycopg2.Error as e:
+            print(f"webhook event {event_id} could not be released: {e}")
+
+
+if __name__ == '__main__':
+    print("This module is not script file.")
@@ -1,42 +1,165 @@
 import os
+import threading
+import time
 
-from flask import Flask, abort, request
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, Response, abort, request
+from linebot import LineBotApi, WebhookParser
 from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from linebot.models import MessageEvent, TextMessage
 
+from inner.catalog import Catalog
+from inner.database import Database
+from inner.dispatcher import KeepAliveHttpClient, ReplyDispatcher
+from inner.loader import Loader
+from inner.metrics import Metrics
+from inner.schema import Schema
 from inner.talker import Talker
+from inner.webhook import WebhookEvents
 
+# 起動時の準備の方法です。 syncは準備を終えてからトラフィックを受け付け、backgroundは準備中の/healthzに503を返します。
+# 0を指定すると準備をせず、最初のメッセージを処理する時に必要なものを読み込みます。
+# 準備に失敗した場合はどちらもWARMUP_RETRY秒毎にスレッドでやり直し、成功するまで/healthzと/callbackに503を返します。
+WARMUP = os.getenv('WARMUP', 'sync')
+WARMUP_RETRY = float(os.getenv('WARMUP_RETRY', 5))
+READY_TIMEOUT = float(os.getenv('READY_TIMEOUT', 20))
+ready = threading.Event()
 talker = Talker()
 app = Flask(__name__)
 YOUR_CHANNEL_ACCESS_TOKEN = os.environ['YOUR_CHANNEL_ACCESS_TOKEN']
 YOUR_CHANNEL_SECRET = os.environ['YOUR_CHANNEL_SECRET']
-line_bot_api = LineBotApi(YOUR_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(YOUR_CHANNEL_SECRET)
+LINE_API_ENDPOINT = os.getenv('LINE_API_ENDPOINT',
+                              LineBotApi.DEFAULT_API_ENDPOINT)
+line_bot_api = LineBotApi(YOUR_CHANNEL_ACCESS_TOKEN,
+                          endpoint=LINE_API_ENDPOINT,
+                          http_client=KeepAliveHttpClient)
+dispatcher = ReplyDispatcher(line_bot_api)
+parser = WebhookParser(YOUR_CHANNEL_SECRET)
+# 会話状態を共有する場合は全てのワーカーが同じ合計を返すため、ワーカー間で足し合わせないでください。
+if talker.users.SHARED:
+    SESSIONS_HELP = ('Sessions in the store shared by all workers '
+                     '(same value on every worker; do not sum).')
+else:
+    SESSIONS_HELP = 'Sessions currently held by this process.'
+Metrics.gauge('linebot_sessions_active', SESSIONS_HELP,
+              lambda: len(talker.users))
+
+
+def warm_up():
+    """最初のメッセージへの返信が遅くならないよう、トラフィックを受け付ける前に準備を済ませます。
+    スキーマの適用、辞書の読み込み、データベースへの接続、Catalogの読み込みを行い、
+    最後に商品検索の会話を一度処理して、検索に使う索引や正規表現を用意します。
+    返信APIへの接続は、失敗しても返信時に接続し直せるため、準備の完了を待たせずに最後に行います。
+    """
+    with Metrics.stage('warmup'):
+        Schema.setup()
+        Loader.load_action()
+        Loader.load_add_keys()
+        Loader.load_add_response_table()
+        Database.warm()
+        if Catalog.ENABLED:
+            Catalog.load()
+            Catalog.start()
+        talker.reload_actions()
+        talker.dialogue('warmup', 'warmup')
+        talker.delete_user('warmup')
+    ready.set()
+    dispatcher.warm()
+
+
+def retry(task, wait=0):
+    """taskが成功するまでWARMUP_RETRY秒毎にやり直します。
+
+    Args:
+        task (func): 引数を取らない関数。
+        wait (float, optional): 最初に実行するまでに待つ秒数。
+    """
+    time.sleep(wait)
+    while True:
+        try:
+            task()
+            return
+        except Exception as e:
+            print(f"{task.__name__} failed: {e!r}. "
+                  f"retrying in {WARMUP_RETRY} seconds.")
+            time.sleep(WARMUP_RETRY)
+
+
+def start(task):
+    """taskを実行します。 失敗した場合はスレッドでやり直します。
+    読み込み時に例外を送出するとワーカーが起動と停止を繰り返すため、失敗しても読み込みは完了させます。
+
+    Args:
+        task (func): 引数を取らない関数。
+    """
+    try:
+        task()
+    except Exception as e:
+        print(f"{task.__name__} failed: {e!r}. retrying in the background.")
+        threading.Thread(target=retry, args=(task, WARMUP_RETRY),
+                         daemon=True).start()
+
+
+if WARMUP == 'background':
+    threading.Thread(target=retry, args=(warm_up, ), daemon=True).start()
+elif WARMUP == '0':
+    ready.set()
+    start(Schema.setup)
+else:
+    start(warm_up)
 
 
 @app.route('/callback', methods=['POST'])
 def callback():
+    if not ready.wait(READY_TIMEOUT):
+        abort(503)
     signature = request.headers['X-Line-Signature']
 
     body = request.get_data(as_text=True)
     # app.logger.info(f"Request body: {body}")
 
     try:
-        handler.handle(body, signature)
+        with Metrics.stage('verify'):
+            events = parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
+    for event in events:
+        if not isinstance(event, MessageEvent):
+            continue
+        if not isinstance(event.message, TextMessage):
+            continue
+        # 再送されたイベントを処理しないため、webhookEventId(無ければ返信トークン)を全てのワーカーで共有して記録します。
+        # 処理に失敗した場合は記録を取り消し、LINEからの再送で処理し直します。
+        key = getattr(event, 'webhook_event_id', None) or event.reply_token
+        if not WebhookEvents.claim(key):
+            continue
+        try:
+            handle_message(event)
+        except Exception:
+            WebhookEvents.release(key)
+            raise
+    return 'OK'
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    if not ready.is_set():
+        return 'warming up', 503
     return 'OK'
 
 
-@handler.add(MessageEvent, message=TextMessage)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(Metrics.render(), content_type=Metrics.CONTENT_TYPE)
+
+
 def handle_message(event):
     text = event.message.text
     user_id = event.source.user_id
-    res = talker.dialogue(user_id, text)
+    with Metrics.stage('dialogue'):
+        res = talker.dialogue(user_id, text)
     if res is None:
         return
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=res))
+    dispatcher.send(event.reply_token, res)
 
 
 if __name__ == '__main__':